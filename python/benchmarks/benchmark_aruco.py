@@ -0,0 +1,141 @@
+import numpy as np
+import cv2
+import os
+import os.path as osp
+import io
+import tempfile
+from contextlib import redirect_stdout
+from time import monotonic
+from benchmark_utils import build_base_parser, measure
+from kas_utils.aruco import detect_aruco, get_aruco_corners_3d, detect_aruco_common, \
+    ArucoTracker
+
+
+def build_parser():
+    parser = build_base_parser(repeat=20)
+    parser.add_argument('-rows', '--rows', type=int, default=10)
+    parser.add_argument('-cols', '--cols', type=int, default=12)
+    parser.add_argument('-images', '--images', type=int, default=100)
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('-frames', '--frames', type=int, default=60)
+    return parser
+
+
+def generate_board_image(rows, cols, marker_pixels=60, gap_pixels=20,
+        dictionary=cv2.aruco.DICT_5X5_1000):
+    aruco_dict = cv2.aruco.Dictionary_get(dictionary)
+    step = marker_pixels + gap_pixels
+    board = np.full((rows * step + gap_pixels, cols * step + gap_pixels), 255, dtype=np.uint8)
+    for i in range(rows * cols):
+        y = gap_pixels + (i // cols) * step
+        x = gap_pixels + (i % cols) * step
+        board[y:y + marker_pixels, x:x + marker_pixels] = \
+            cv2.aruco.drawMarker(aruco_dict, i, marker_pixels)
+
+    # look at the board at an angle
+    h, w = board.shape
+    src = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+    dst = np.float32([[w * 0.05, h * 0.1], [w * 0.95, 0], [w, h], [0, h * 0.95]])
+    image = cv2.warpPerspective(board, cv2.getPerspectiveTransform(src, dst), (w, h),
+        borderValue=255)
+    K = np.array([[w, 0, w / 2], [0, w, h / 2], [0, 0, 1]])
+    D = np.array([0.05, -0.02, 0, 0, 0])
+    return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR), K, D
+
+
+def estimate_poses_per_marker(corners, aruco_size, K, D):
+    # reference: build object points and convert rotations for every marker
+    corners_3d = list()
+    for i in range(len(corners)):
+        obj = np.array([
+            [-aruco_size / 2,  aruco_size / 2, 0],
+            [ aruco_size / 2,  aruco_size / 2, 0],
+            [ aruco_size / 2, -aruco_size / 2, 0],
+            [-aruco_size / 2, -aruco_size / 2, 0]])
+        _, rvec, tvec, _ = cv2.solvePnPGeneric(obj, corners[i], K, D,
+            flags=cv2.SOLVEPNP_IPPE_SQUARE, reprojectionError=np.empty(0, dtype=float))
+        for rvec, tvec in zip(rvec, tvec):
+            R, _ = cv2.Rodrigues(rvec)
+            corners_3d.append(np.matmul(obj, R.T) + tvec[:, 0])
+    return corners_3d
+
+
+def benchmark_poses(rows, cols, repeat, aruco_size=0.05):
+    image, K, D = generate_board_image(rows, cols)
+    arucos = detect_aruco(image)
+    corners = arucos.corners
+
+    def estimate():
+        arucos = detect_aruco(image, K=K, D=D, aruco_sizes=aruco_size, use_generic=True)
+        get_aruco_corners_3d(arucos)
+
+    detection_time = measure(lambda: detect_aruco(image), repeat)
+    reference_time = measure(
+        lambda: estimate_poses_per_marker(corners, aruco_size, K, D), repeat)
+    batched_time = measure(estimate, repeat) - detection_time
+    print(f"{arucos.n} markers: detection {detection_time * 1000:.02f} ms, "
+        f"poses and 3d corners per marker {reference_time * 1000:.02f} ms, "
+        f"batched {batched_time * 1000:.02f} ms")
+
+
+def benchmark_batch(rows, cols, n_images, jobs, aruco_size=0.05):
+    # detect_aruco_common() uses 4x4 dictionary
+    image, K, D = generate_board_image(rows, cols, dictionary=cv2.aruco.DICT_4X4_1000)
+    with tempfile.TemporaryDirectory() as folder:
+        images_files = list()
+        for i in range(n_images):
+            image_file = osp.join(folder, f"{i:06d}.png")
+            cv2.imwrite(image_file, image)
+            images_files.append(image_file)
+
+        for visualize in (False, True):
+            throughputs = list()
+            for n_jobs in sorted({1, jobs}):
+                start = monotonic()
+                with redirect_stdout(io.StringIO()):
+                    detect_aruco_common(images_files, K, D, aruco_size,
+                        osp.join(folder, "out"), visualize=visualize, jobs=n_jobs)
+                throughputs.append(f"{n_jobs} jobs {n_images / (monotonic() - start):.01f} images/s")
+            print(f"{n_images} images{' with visualization' if visualize else ''}: " +
+                ", ".join(throughputs))
+
+
+def generate_video(rows, cols, n_frames, width=1920, height=1080):
+    # small board moving and rotating across big frame
+    board, _, _ = generate_board_image(rows, cols)
+    K = np.array([[width, 0, width / 2], [0, width, height / 2], [0, 0, 1]])
+    D = np.zeros(5)
+    center = (board.shape[1] / 2, board.shape[0] / 2)
+    frames = list()
+    for i in range(n_frames):
+        M = cv2.getRotationMatrix2D(center, 0.5 * i, 1)
+        M[:, 2] += (width / 4 + 5 * i, height / 4 + 3 * i)
+        frame = np.full((height, width, 3), 255, dtype=np.uint8)
+        cv2.warpAffine(board, M, (width, height), dst=frame, borderMode=cv2.BORDER_TRANSPARENT)
+        frames.append(frame)
+    return frames, K, D
+
+
+def benchmark_tracking(n_frames, aruco_size=0.05):
+    frames, K, D = generate_video(3, 4, n_frames)
+    start = monotonic()
+    detected = [detect_aruco(frame, K=K, D=D, aruco_sizes=aruco_size) for frame in frames]
+    detection_time = (monotonic() - start) / n_frames
+
+    tracker = ArucoTracker(K=K, D=D, aruco_sizes=aruco_size)
+    start = monotonic()
+    tracked = [tracker.track(frame) for frame in frames]
+    tracking_time = (monotonic() - start) / n_frames
+
+    lost = sum(np.setdiff1d(d.ids, t.ids).size for d, t in zip(detected, tracked))
+    print(f"{n_frames} frames: detection {detection_time * 1000:.02f} ms/frame, "
+        f"tracking {tracking_time * 1000:.02f} ms/frame "
+        f"({tracker.full_detections_counter} full detections, {lost} lost markers)")
+
+
+if __name__ == "__main__":
+    parser = build_parser()
+    args = parser.parse_args()
+    benchmark_poses(args.rows, args.cols, args.repeat)
+    benchmark_batch(args.rows, args.cols, args.images, args.jobs)
+    benchmark_tracking(args.frames)
@@ -0,0 +1,62 @@
+import numpy as np
+from benchmark_utils import build_base_parser, measure
+from kas_utils.plane_frame import PlaneFrame
+
+
+def build_parser():
+    parser = build_base_parser()
+    parser.add_argument('-n', '--points', type=int, default=1000000)
+    return parser
+
+
+def generate_plane_points(n, rng, noise=0.01):
+    points = rng.uniform(-2, 2, size=(n, 3))
+    points[:, 2] = 0.1 * points[:, 0] - 0.2 * points[:, 1] + 1.5 + \
+        rng.normal(scale=noise, size=n)
+    return points
+
+
+def to_plane_homogeneous(plane_frame, points):
+    # reference: pad points to homogeneous coordinates and multiply by 4x4 matrix
+    points = np.pad(points, [(0, 0), (0, 1)], mode='constant', constant_values=1)
+    points = np.expand_dims(points, axis=-1)
+    points = np.matmul(plane_frame.plane2origin().copy(), points)
+    return points[..., 0][..., :3]
+
+
+def benchmark_transforms(n, repeat):
+    rng = np.random.default_rng(0)
+    points = generate_plane_points(n, rng)
+    plane_frame = PlaneFrame.from_points(points[:1000])
+    points_float32 = points.astype(np.float32)
+    out = np.empty_like(points_float32)
+
+    homogeneous_time = measure(lambda: to_plane_homogeneous(plane_frame, points), repeat)
+    to_plane_time = measure(lambda: plane_frame.to_plane(points), repeat)
+    float32_time = measure(lambda: plane_frame.to_plane(points_float32), repeat)
+    out_time = measure(lambda: plane_frame.to_plane(points_float32, out=out), repeat)
+    print(f"{n} points: homogeneous {homogeneous_time * 1000:.02f} ms, "
+        f"to_plane {to_plane_time * 1000:.02f} ms, "
+        f"float32 {float32_time * 1000:.02f} ms, "
+        f"float32 with out {out_time * 1000:.02f} ms")
+
+
+def benchmark_robust_fitting(n, repeat, outliers_rate=0.4):
+    rng = np.random.default_rng(0)
+    points = generate_plane_points(n, rng, noise=0.003)
+    outliers = rng.random(n) < outliers_rate
+    points[outliers] = rng.uniform(-2, 2, size=(np.count_nonzero(outliers), 3))
+    points = points.astype(np.float32)
+
+    robust_time = measure(lambda: PlaneFrame.from_points_robust(points), repeat)
+    _, inliers = PlaneFrame.from_points_robust(points)
+    accuracy = np.mean(inliers == ~outliers)
+    print(f"{n} points with {outliers_rate * 100:.0f}% outliers: "
+        f"from_points_robust {robust_time * 1000:.02f} ms, inliers accuracy {accuracy:.03f}")
+
+
+if __name__ == "__main__":
+    parser = build_parser()
+    args = parser.parse_args()
+    benchmark_transforms(args.points, args.repeat)
+    benchmark_robust_fitting(args.points, args.repeat)
@@ -0,0 +1,17 @@
+import argparse
+from time import monotonic
+
+
+def build_base_parser(repeat=10):
+    # parser with arguments shared by all benchmarks
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-repeat', '--repeat', type=int, default=repeat)
+    return parser
+
+
+def measure(func, repeat):
+    # average run time of func in seconds
+    start = monotonic()
+    for _ in range(repeat):
+        func()
+    return (monotonic() - start) / repeat
@@ -0,0 +1,73 @@
+import numpy as np
+import cv2
+from benchmark_utils import build_base_parser, measure
+from kas_utils.visualization import draw_objects, draw_points
+
+
+def build_parser():
+    parser = build_base_parser()
+    parser.add_argument('-width', '--width', type=int, default=1280)
+    parser.add_argument('-height', '--height', type=int, default=720)
+    parser.add_argument('-n', '--instances', type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument('-points', '--points', type=int, default=300000)
+    return parser
+
+
+def generate_objects(n, width, height, rng):
+    masks = np.zeros((n, height, width), dtype=np.uint8)
+    boxes = np.empty((n, 4), dtype=int)
+    for mask, box in zip(masks, boxes):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        axes = (int(rng.integers(5, 80)), int(rng.integers(5, 80)))
+        cv2.ellipse(mask, center, axes, 0, 0, 360, 1, -1)
+        nonzero_y, nonzero_x = np.nonzero(mask)
+        box[:] = (nonzero_x.min(), nonzero_y.min(), nonzero_x.max(), nonzero_y.max())
+    scores = rng.random(n)
+    objects_ids = np.arange(n)
+    return scores, objects_ids, boxes, masks
+
+
+def draw_masks_per_instance(image, masks, palette):
+    # reference: per instance full image overlay and contours
+    overlay = image.copy()
+    for i, mask in enumerate(masks):
+        color = palette[i % len(palette)]
+        overlay[mask != 0] = np.array(color, dtype=np.uint8)
+        polygons, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+        cv2.polylines(image, polygons, True, color, thickness=2)
+    cv2.addWeighted(image, 0.7, overlay, 0.3, 0, dst=image)
+
+
+def benchmark_visualization(width, height, instances, points, repeat):
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    palette = ((0, 0, 255), (0, 255, 0), (255, 0, 0))
+    for n in instances:
+        scores, objects_ids, boxes, masks = generate_objects(n, width, height, rng)
+        reference_time = measure(
+            lambda: draw_masks_per_instance(image.copy(), masks, palette), repeat)
+        draw_objects_time = measure(
+            lambda: draw_objects(image.copy(), scores, objects_ids, None, masks,
+                draw_ids=True, draw_masks=True, palette=palette), repeat)
+        print(f"{n} instances: per instance {reference_time * 1000:.02f} ms, "
+            f"draw_objects {draw_objects_time * 1000:.02f} ms")
+
+    K = np.array([
+        [width / 2, 0, width / 2],
+        [0, width / 2, height / 2],
+        [0, 0, 1]])
+    D = np.zeros((5,))
+    cloud = rng.normal(size=(points, 3)) + np.array([0, 0, 3])
+    draw_points_time = measure(
+        lambda: draw_points(image.copy(), K, D, cloud), repeat)
+    z_buffer_time = measure(
+        lambda: draw_points(image.copy(), K, D, cloud, z_buffer=True), repeat)
+    print(f"{points} points: draw_points {draw_points_time * 1000:.02f} ms, "
+        f"with z buffer {z_buffer_time * 1000:.02f} ms")
+
+
+if __name__ == "__main__":
+    parser = build_parser()
+    args = parser.parse_args()
+    benchmark_visualization(args.width, args.height, args.instances, args.points,
+        args.repeat)
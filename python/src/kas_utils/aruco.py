@@ -2,12 +2,14 @@ import argparse
 import numpy as np
 import cv2
 import glob
+import json
+import multiprocessing
 import os
 import os.path as osp
 from pathlib import Path
-from copy import deepcopy
+from functools import lru_cache
 from packaging import version
-from shapely.geometry import Polygon
+from kas_utils.visualization import VideoSink
 
 
 assert version.parse(cv2.__version__) >= version.parse("4.5.2")
@@ -19,10 +21,31 @@ def build_parser():
     parser.add_argument('-ext', '--images-extension', type=str, default='jpg')
     parser.add_argument('-calib', '--camera-calibration', required=True, type=str)
     parser.add_argument('-size', '--aruco-size', required=True, type=float)
-    parser.add_argument('-out-fld', '--out-folder', required=True, type=str)
+    parser.add_argument('-out-fld', '--out-folder', type=str,
+        help="folder for visualization images, not needed with -out-video")
+    parser.add_argument('-out-video', '--out-video-file', type=str)
+    parser.add_argument('-no-vis', '--no-visualization', action='store_true')
+    parser.add_argument('-results', '--results-file', type=str,
+        help="json file with ids, corners and poses of markers for every image")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help="number of worker processes")
     return parser
 
+@lru_cache(maxsize=8)
+def _get_aruco_dtype(n_poses):
+    # n_poses = -1 if poses are not estimated
+    fields = [('id', np.int32, (1,)), ('corners', np.float32, (1, 4, 2))]
+    if n_poses > 0:
+        fields += [('size', np.float64), ('rvec', np.float64, (n_poses, 3)),
+            ('tvec', np.float64, (n_poses, 3)), ('error', np.float64, (n_poses,))]
+    return np.dtype(fields)
+
+
 class ArucoList:
+    # Markers are stored in a single structured array self.data
+    # (fields - id, corners, size, rvec, tvec, error; last four only if poses are estimated),
+    # attributes below are views of its fields. Views are not contiguous,
+    # use np.ascontiguousarray() before passing them to OpenCV functions.
     # self.corners.shape = (n, 1, 4, 2)
     # self.ids.shape = (n, 1)
     # self.rejected.shape = (n_rejected, 1, 4, 2)
@@ -31,22 +54,68 @@ class ArucoList:
     # self.tvecs.shape = (n, n_poses, 3)
     # self.reprojection_errors = (n, n_poses)
 
-    def __init__(self):
-        self.reset()
+    __slots__ = ('data', 'rejected', 'n_poses')
+
+    def __init__(self, data=None, rejected=None, n_poses=-1):
+        self.data = data
+        self.rejected = rejected
+        self.n_poses = n_poses
+
+    @classmethod
+    def from_arrays(cls, ids, corners, rejected, aruco_sizes=None,
+            rvecs=None, tvecs=None, reprojection_errors=None):
+        n_poses = rvecs.shape[1] if rvecs is not None else -1
+        data = np.empty(len(ids), dtype=_get_aruco_dtype(n_poses))
+        data['id'] = ids
+        data['corners'] = corners
+        if n_poses > 0:
+            data['size'] = aruco_sizes
+            data['rvec'] = rvecs
+            data['tvec'] = tvecs
+            data['error'] = reprojection_errors
+        return cls(data, rejected, n_poses)
 
     def reset(self):
-        self.n = -1
-        self.corners = None
-        self.ids = None
-
-        self.n_rejected = -1
+        self.data = None
         self.rejected = None
-
-        self.aruco_sizes = None
         self.n_poses = -1
-        self.rvecs = None
-        self.tvecs = None
-        self.reprojection_errors = None
+
+    def _get_field(self, name):
+        if self.data is None or name not in self.data.dtype.names:
+            return None
+        return self.data[name]
+
+    @property
+    def n(self):
+        return len(self.data) if self.data is not None else -1
+
+    @property
+    def n_rejected(self):
+        return len(self.rejected) if self.rejected is not None else -1
+
+    @property
+    def ids(self):
+        return self._get_field('id')
+
+    @property
+    def corners(self):
+        return self._get_field('corners')
+
+    @property
+    def aruco_sizes(self):
+        return self._get_field('size')
+
+    @property
+    def rvecs(self):
+        return self._get_field('rvec')
+
+    @property
+    def tvecs(self):
+        return self._get_field('tvec')
+
+    @property
+    def reprojection_errors(self):
+        return self._get_field('error')
 
     def get_pose(self, i, i_pose):
         rvec = self.rvecs[i, i_pose]
@@ -58,44 +127,30 @@ class ArucoList:
 
 
 class PoseSelectors:
-    # rvec.shape = (n_poses, 3)
-    # tvec.shape = (n_poses, 3)
-    # reprojection_error.shape = (n_poses,)
-
-    def _select_by_rotation_matrix(rvec, get_rotation_matrix_score):
-        scores = list()
-        n_poses = rvec.shape[0]
-        for i in range(n_poses):
-            R, _ = cv2.Rodrigues(rvec[i])
-            score = get_rotation_matrix_score(R)
-            scores.append(score)
-
-        scores = np.array(scores)
-        selected = scores.argmax()
-        return selected
-
-    def Z_axis_up(rvec, tvec, reprojection_error):
-        def get_rotation_matrix_score(R):
-            score = -R[:, 2][1]  # minus Y component of aruco Z axis
-            return score
-        selected = PoseSelectors._select_by_rotation_matrix(
-            rvec, get_rotation_matrix_score)
+    # Selectors choose one pose for every marker.
+    # rvecs.shape = (n, n_poses, 3)
+    # tvecs.shape = (n, n_poses, 3)
+    # reprojection_errors.shape = (n, n_poses)
+    # Return indices of selected poses (shape - (n,)).
+
+    def Z_axis_up(rvecs, tvecs, reprojection_errors):
+        R = _rodrigues(rvecs)
+        scores = -R[:, :, 1, 2]  # minus Y component of aruco Z axis
+        selected = scores.argmax(axis=1)
         return selected
 
-    def Z_axis_back(rvec, tvec, reprojection_error):
-        def get_rotation_matrix_score(R):
-            score = -R[:, 2][2]  # minus Z component of aruco Z axis
-            return score
-        selected = PoseSelectors._select_by_rotation_matrix(
-            rvec, get_rotation_matrix_score)
+    def Z_axis_back(rvecs, tvecs, reprojection_errors):
+        R = _rodrigues(rvecs)
+        scores = -R[:, :, 2, 2]  # minus Z component of aruco Z axis
+        selected = scores.argmax(axis=1)
         return selected
 
-    def best(rvec, tvec, reprojection_error):
-        selected = np.argmin(reprojection_error)
+    def best(rvecs, tvecs, reprojection_errors):
+        selected = np.argmin(reprojection_errors, axis=1)
         return selected
 
-    def worst(rvec, tvec, reprojection_error):
-        selected = np.argmax(reprojection_error)
+    def worst(rvecs, tvecs, reprojection_errors):
+        selected = np.argmax(reprojection_errors, axis=1)
         return selected
 
 
@@ -109,6 +164,230 @@ class RetryRejectedParameters:
         self.add_retried_areas_to_rejected = False
 
 
+# gap between crops in mosaic of retried areas
+_MOSAIC_PADDING = 4
+
+
+def _retry_rejected(image, rejected, aruco_dict, params, retry_rejected_params):
+    # Detects markers again in upscaled areas around small rejected candidates.
+    # Overlapping areas are merged and all areas are tiled into a single mosaic image,
+    # so detectMarkers() is called once.
+    # rejected.shape = (n_rejected, 1, 4, 2)
+    # Returns corners (shape - (m, 1, 4, 2)), ids (shape - (m, 1))
+    # and retried areas to add to rejected (shape - (k, 1, 4, 2)).
+    image_w, image_h = image.shape[1], image.shape[0]
+    max_rejected_area = retry_rejected_params.max_rejected_area
+    border_rate = retry_rejected_params.border_rate
+    subtract = retry_rejected_params.subtract
+    scale = retry_rejected_params.scale
+    max_area_difference = retry_rejected_params.max_area_difference
+    add_retried_areas_to_rejected = retry_rejected_params.add_retried_areas_to_rejected
+
+    rejected = rejected[:, 0]
+    rejected = rejected[_get_quads_areas(rejected) <= max_rejected_area]
+    if len(rejected) == 0:
+        return np.empty((0, 1, 4, 2), dtype=np.float32), \
+            np.empty((0, 1), dtype=np.int32), np.empty((0, 1, 4, 2), dtype=np.float32)
+
+    min_xy = rejected.min(axis=1)
+    max_xy = rejected.max(axis=1)
+    rej_wh = max_xy - min_xy
+    boxes = np.empty((len(rejected), 4), dtype=int)
+    boxes[:, 0] = np.maximum((min_xy[:, 0] - rej_wh[:, 0] * border_rate).astype(int), 0)
+    boxes[:, 1] = np.maximum((min_xy[:, 1] - rej_wh[:, 1] * border_rate).astype(int), 0)
+    boxes[:, 2] = np.minimum((max_xy[:, 0] + rej_wh[:, 0] * border_rate).astype(int), image_w)
+    boxes[:, 3] = np.minimum((max_xy[:, 1] + rej_wh[:, 1] * border_rate).astype(int), image_h)
+    # boxes: [from_x, from_y, to_x, to_y]
+
+    if add_retried_areas_to_rejected:
+        retried_areas = np.stack((
+            boxes[:, [0, 1]], boxes[:, [0, 3]], boxes[:, [2, 3]], boxes[:, [2, 1]]),
+            axis=1)[:, np.newaxis].astype(rejected.dtype)
+    else:
+        retried_areas = np.empty((0, 1, 4, 2), dtype=rejected.dtype)
+
+    boxes, groups = _merge_boxes(boxes)
+    crops = list()
+    for from_x, from_y, to_x, to_y in boxes:
+        crop = image[from_y:to_y, from_x:to_x]
+        if subtract != 0:
+            crop = crop - np.minimum(crop, subtract).astype(crop.dtype)
+        crop_w, crop_h = crop.shape[1], crop.shape[0]
+        crops.append(cv2.resize(crop, (crop_w * scale, crop_h * scale)))
+    mosaic, offsets = _build_mosaic(crops, _MOSAIC_PADDING)
+
+    mosaic_corners, mosaic_ids, _ = \
+        cv2.aruco.detectMarkers(mosaic, aruco_dict, parameters=params)
+    if len(mosaic_corners) == 0:
+        return np.empty((0, 1, 4, 2), dtype=np.float32), \
+            np.empty((0, 1), dtype=np.int32), retried_areas
+    mosaic_corners = np.array(mosaic_corners)[:, 0]
+    mosaic_ids = mosaic_ids[:, 0]
+
+    detected_corners, detected_crops, detected_in_crop = \
+        _map_from_mosaic(mosaic_corners, crops, offsets, boxes, scale)
+    mosaic_ids = mosaic_ids[detected_in_crop]
+
+    # accept markers whose areas are similar to any of rejected candidates of the crop
+    pairs_detected, pairs_rejected = \
+        np.nonzero(detected_crops[:, np.newaxis] == groups[np.newaxis])
+    detected_quads = detected_corners[pairs_detected]
+    rejected_quads = rejected[pairs_rejected]
+    intersection_areas = _get_convex_quads_intersection_areas(detected_quads, rejected_quads)
+    diff_1 = np.abs(_get_quads_areas(rejected_quads) - intersection_areas)
+    diff_2 = np.abs(_get_quads_areas(detected_quads) - intersection_areas)
+    accepted_pairs = np.maximum(diff_1, diff_2) <= max_area_difference
+    accepted = np.zeros(len(detected_corners), dtype=bool)
+    accepted[pairs_detected[accepted_pairs]] = True
+
+    retried_corners = detected_corners[accepted][:, np.newaxis].astype(np.float32)
+    retried_ids = mosaic_ids[accepted][:, np.newaxis]
+    return retried_corners, retried_ids, retried_areas
+
+
+def _map_from_mosaic(mosaic_corners, crops, offsets, boxes, scale):
+    # Finds crops of markers detected in mosaic and moves their corners back to image.
+    # mosaic_corners.shape = (n, 4, 2)
+    # Returns corners of markers inside crops, indices of their crops
+    # and mask of markers inside crops.
+    crops_wh = np.array([(crop.shape[1], crop.shape[0]) for crop in crops])
+    centers = mosaic_corners.mean(axis=1)
+    inside = np.all((centers[:, np.newaxis] >= offsets) &
+        (centers[:, np.newaxis] < offsets + crops_wh), axis=2)
+    # inside.shape = (n, n_crops)
+    in_crop = np.any(inside, axis=1)
+    crops_indices = np.argmax(inside[in_crop], axis=1)
+    corners = (mosaic_corners[in_crop] - offsets[crops_indices, np.newaxis]) / scale + \
+        boxes[crops_indices, np.newaxis, :2]
+    return corners, crops_indices, in_crop
+
+
+def _merge_boxes(boxes):
+    # Merges overlapping boxes if merged box is not larger than both boxes together.
+    # boxes: [from_x, from_y, to_x, to_y]
+    # Returns merged boxes and index of merged box for every input box.
+    boxes = boxes.copy()
+    n = len(boxes)
+    groups = np.arange(n)
+    alive = np.ones(n, dtype=bool)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    i = 0
+    while i < n:
+        if not alive[i]:
+            i += 1
+            continue
+        overlap = alive & \
+            (boxes[:, 0] < boxes[i, 2]) & (boxes[:, 2] > boxes[i, 0]) & \
+            (boxes[:, 1] < boxes[i, 3]) & (boxes[:, 3] > boxes[i, 1])
+        overlap[i] = False
+        union = np.hstack((np.minimum(boxes[:, :2], boxes[i, :2]),
+            np.maximum(boxes[:, 2:], boxes[i, 2:])))
+        union_areas = (union[:, 2] - union[:, 0]) * (union[:, 3] - union[:, 1])
+        candidates = np.flatnonzero(overlap & (union_areas <= areas + areas[i]))
+        if len(candidates) == 0:
+            i += 1
+            continue
+        # merge and check grown box again
+        j = candidates[0]
+        boxes[i] = union[j]
+        areas[i] = union_areas[j]
+        alive[j] = False
+        groups[groups == j] = i
+    merged_indices = np.cumsum(alive) - 1
+    return boxes[alive], merged_indices[groups]
+
+
+def _build_mosaic(images, padding):
+    # Tiles images in rows (shelf packing). Every image is surrounded
+    # by padding pixels replicating its border.
+    # Returns mosaic and offsets of images in mosaic (shape - (n, 2), [x, y]).
+    sizes = np.array([(image.shape[1], image.shape[0]) for image in images]) + 2 * padding
+    max_row_w = max(sizes[:, 0].max(), int(np.sqrt(np.sum(sizes[:, 0] * sizes[:, 1]))))
+    order = np.argsort(-sizes[:, 1], kind='stable')
+    offsets = np.empty((len(images), 2), dtype=int)
+    x, y, row_h, mosaic_w = 0, 0, 0, 0
+    for i in order:
+        w, h = sizes[i]
+        if x + w > max_row_w:
+            x, y, row_h = 0, y + row_h, 0
+        offsets[i] = (x, y)
+        x += w
+        row_h = max(row_h, h)
+        mosaic_w = max(mosaic_w, x)
+    mosaic_h = y + row_h
+
+    mosaic = np.zeros((mosaic_h, mosaic_w) + images[0].shape[2:], dtype=images[0].dtype)
+    for image, (x, y), (w, h) in zip(images, offsets, sizes):
+        mosaic[y:y + h, x:x + w] = cv2.copyMakeBorder(image,
+            padding, padding, padding, padding, cv2.BORDER_REPLICATE)
+    return mosaic, offsets + padding
+
+
+def _get_quads_areas(quads):
+    # quads.shape = (..., 4, 2)
+    x = quads[..., 0]
+    y = quads[..., 1]
+    return 0.5 * np.abs(np.sum(x * np.roll(y, -1, axis=-1) - np.roll(x, -1, axis=-1) * y, axis=-1))
+
+
+def _get_convex_quads_intersection_areas(quads_1, quads_2):
+    # Areas of intersection of pairs of convex quadrilaterals, shape - (n, 4, 2).
+    # By Green's theorem the area is half of the sum of cross products
+    # of ends of boundary segments. The boundary of intersection consists
+    # of parts of edges of each quad inside the other one.
+    quads_1 = _make_counterclockwise(np.asarray(quads_1, dtype=np.float64))
+    quads_2 = _make_counterclockwise(np.asarray(quads_2, dtype=np.float64))
+    # common edges are counted once, as edges of quads_1
+    doubled_area = \
+        _sum_clipped_edges_cross(quads_1, quads_2, include_boundary=True) + \
+        _sum_clipped_edges_cross(quads_2, quads_1, include_boundary=False)
+    return np.maximum(doubled_area / 2, 0)
+
+
+def _make_counterclockwise(quads):
+    x = quads[..., 0]
+    y = quads[..., 1]
+    signed_areas = np.sum(x * np.roll(y, -1, axis=-1) - np.roll(x, -1, axis=-1) * y, axis=-1)
+    return np.where((signed_areas < 0)[:, np.newaxis, np.newaxis], quads[:, ::-1], quads)
+
+
+def _sum_clipped_edges_cross(quads, clip_quads, include_boundary):
+    # Sum of cross products of ends of parts of edges of quads inside clip_quads.
+    # Edges are clipped by half planes of clip_quads edges (Cyrus-Beck).
+    starts = quads[:, :, np.newaxis]
+    directions = np.roll(quads, -1, axis=1)[:, :, np.newaxis] - starts
+    clip_starts = clip_quads[:, np.newaxis]
+    clip_directions = np.roll(clip_quads, -1, axis=1)[:, np.newaxis] - clip_starts
+    # point starts + t * directions is inside of clip edge if numerators + t * denominators >= 0
+    numerators = _cross(clip_directions, starts - clip_starts)
+    denominators = _cross(clip_directions, directions)
+    # numerators.shape = denominators.shape = (n, edges, clip edges)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = -numerators / denominators
+    t_from = np.max(np.where(denominators > 0, t, 0), axis=2)
+    t_to = np.min(np.where(denominators < 0, t, 1), axis=2)
+    if include_boundary:
+        # edge on clip edge bounds intersection only if quads are on the same side of it
+        same_directions = np.sum(directions * clip_directions, axis=-1) > 0
+        outside = (denominators == 0) & \
+            ((numerators < 0) | ((numerators == 0) & ~same_directions))
+    else:
+        outside = (denominators == 0) & (numerators <= 0)
+    valid = (t_to > t_from) & ~np.any(outside, axis=2)
+
+    starts = starts[:, :, 0]
+    directions = directions[:, :, 0]
+    segments_starts = starts + t_from[..., np.newaxis] * directions
+    segments_ends = starts + t_to[..., np.newaxis] * directions
+    crosses = _cross(segments_starts, segments_ends)
+    return np.sum(np.where(valid, crosses, 0), axis=1)
+
+
+def _cross(a, b):
+    return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+
 def detect_aruco(image, K=None, D=None, aruco_sizes=None, use_generic=False,
         retry_rejected=False, retry_rejected_params=RetryRejectedParameters(),
         aruco_dict=cv2.aruco.Dictionary_get(cv2.aruco.DICT_5X5_1000),
@@ -118,58 +397,26 @@ def detect_aruco(image, K=None, D=None, aruco_sizes=None, use_generic=False,
     corners = list(corners)
     rejected = list(rejected)
 
-    if retry_rejected:
-        retried_areas = list()
-        image_w, image_h = image.shape[1], image.shape[0]
-        max_rejected_area = retry_rejected_params.max_rejected_area
-        border_rate = retry_rejected_params.border_rate
-        subtract = retry_rejected_params.subtract
-        scale = retry_rejected_params.scale
-        max_area_difference = retry_rejected_params.max_area_difference
-        add_retried_areas_to_rejected = retry_rejected_params.add_retried_areas_to_rejected
-        for rej in rejected:
-            rej_polygon = Polygon(rej[0])
-            if rej_polygon.area > max_rejected_area:
-                continue
-            min_x, min_y = rej.min(axis=(0, 1))
-            max_x, max_y = rej.max(axis=(0, 1))
-            rej_w = max_x - min_x
-            rej_h = max_y - min_y
-            from_x = max(int(min_x - rej_w * border_rate), 0)
-            to_x = min(int(max_x + rej_w * border_rate), image_w)
-            from_y = max(int(min_y - rej_h * border_rate), 0)
-            to_y = min(int(max_y + rej_h * border_rate), image_h)
-            sub_image = image[from_y:to_y, from_x:to_x]
-            if add_retried_areas_to_rejected:
-                retried_areas.append(np.array([[[from_x, from_y], [from_x, to_y],
-                    [to_x, to_y], [to_x, from_y]]], dtype=rej.dtype))
-            if subtract != 0:
-                subtract_array = np.full(sub_image.shape, subtract, dtype=sub_image.dtype)
-                subtract_array[sub_image < subtract] = sub_image[sub_image < subtract]
-                sub_image = sub_image - subtract_array
-            sub_w, sub_h = sub_image.shape[1], sub_image.shape[0]
-            sub_image = cv2.resize(sub_image, (sub_w * scale, sub_h * scale), cv2.INTER_NEAREST)
-            sub_corners, sub_ids, sub_rejected = \
-                cv2.aruco.detectMarkers(sub_image, aruco_dict, parameters=params)
-            for i in range(len(sub_corners)):
-                sub_corns = sub_corners[i]
-                sub_corns /= scale
-                sub_corns += np.array([from_x, from_y])
-                sub_id = sub_ids[i, 0]
-
-                sub_corns_polygon = Polygon(sub_corns[0])
-                intersetion = rej_polygon.intersection(sub_corns_polygon)
-                diff_1 = abs(rej_polygon.area - intersetion.area)
-                diff_2 = abs(sub_corns_polygon.area - intersetion.area)
-                if max(diff_1, diff_2) > max_area_difference:
-                    continue
-
-                corners.append(sub_corns)
-                ids = np.vstack((ids, np.array([[sub_id]])))
+    if retry_rejected and len(rejected) > 0:
+        retried_corners, retried_ids, retried_areas = _retry_rejected(
+            image, np.array(rejected), aruco_dict, params, retry_rejected_params)
+        if len(retried_corners) > 0:
+            corners.extend(retried_corners)
+            ids = retried_ids if ids is None else np.vstack((ids, retried_ids))
         rejected.extend(retried_areas)
 
+    return _build_aruco_list(corners, ids, rejected, K=K, D=D, aruco_sizes=aruco_sizes,
+        use_generic=use_generic)
+
+
+def _build_aruco_list(corners, ids, rejected, K=None, D=None, aruco_sizes=None,
+        use_generic=False, init_poses=None):
+    # corners, rejected: lists of arrays with shape (1, 4, 2) as returned by detectMarkers()
+    # aruco_sizes: size of all markers, sizes of markers sorted by ids
+    #     or dict with sizes by marker ids. Markers with ids missing in dict
+    #     are kept, their poses and reprojection errors are NaN.
+    # init_poses: dict with (rvec, tvec) by marker ids used as initial guess
     n = len(corners)
-    n_rejected = len(rejected)
 
     if n != 0:
         corners = np.array(corners)
@@ -183,9 +430,9 @@ def detect_aruco(image, K=None, D=None, aruco_sizes=None, use_generic=False,
         corners = np.take_along_axis(corners, np.expand_dims(ind, axis=(-1, -2)), axis=0)
     else:
         corners = np.empty((0, 1, 4, 2))
-        ids = np.empty((0, 1))
+        ids = np.empty((0, 1), dtype=np.int32)
 
-    if n_rejected != 0:
+    if len(rejected) != 0:
         rejected = np.array(rejected)
         # rejected.shape = (n_rejected, 1, 4, 2)
     else:
@@ -198,7 +445,10 @@ def detect_aruco(image, K=None, D=None, aruco_sizes=None, use_generic=False,
         n_poses = 2
     if estimate_3d_poses:
         if n != 0:
-            if isinstance(aruco_sizes, (list, tuple)):
+            if isinstance(aruco_sizes, dict):
+                aruco_sizes = np.array([aruco_sizes.get(aruco_id, np.nan)
+                    for aruco_id in ids[:, 0]], dtype=float)
+            elif isinstance(aruco_sizes, (list, tuple)):
                 aruco_sizes = np.array(aruco_sizes)
             elif not isinstance(aruco_sizes, np.ndarray):
                 aruco_sizes = np.array([aruco_sizes] * n)
@@ -209,50 +459,9 @@ def detect_aruco(image, K=None, D=None, aruco_sizes=None, use_generic=False,
                     f"Number of aruco marker sizes does not correspond to "
                     f"the number of detected markers ({aruco_sizes.shape[0]} vs {n})")
 
-            rvecs = list()
-            tvecs = list()
-            reprojection_errors = list()
-            for i in range(n):
-                aruco_size = aruco_sizes[i]
-                obj = np.array([
-                    [-aruco_size / 2,  aruco_size / 2, 0],
-                    [ aruco_size / 2,  aruco_size / 2, 0],
-                    [ aruco_size / 2, -aruco_size / 2, 0],
-                    [-aruco_size / 2, -aruco_size / 2, 0]])
-                if not use_generic:
-                    retval, rvec, tvec = \
-                        cv2.solvePnP(obj, corners[i], K, D,
-                            flags=cv2.SOLVEPNP_IPPE_SQUARE)
-                    rvec = rvec.swapaxes(0, 1)
-                    tvec = tvec.swapaxes(0, 1)
-                    reprojection_error = np.array([-1])  # undefined
-                    # rvec.shape = (n_poses, 3)
-                    # tvec.shape = (n_poses, 3)
-                    # reprojection_error.shape = (n_poses,)
-                else:
-                    retval, rvec, tvec, reprojection_error = \
-                        cv2.solvePnPGeneric(obj, corners[i], K, D,
-                            flags=cv2.SOLVEPNP_IPPE_SQUARE,
-                            reprojectionError=np.empty(0, dtype=float))
-                    assert len(rvec) == n_poses
-                    rvec = np.array(rvec)
-                    tvec = np.array(tvec)
-                    # rvec.shape = (n_poses, 3, 1)
-                    # tvec.shape = (n_poses, 3, 1)
-                    # reprojection_error.shape = (n_poses, 1)
-
-                    rvec = rvec.squeeze()
-                    tvec = tvec.squeeze()
-                    reprojection_error = reprojection_error.squeeze()
-                    # rvec.shape = (n_poses, 3)
-                    # tvec.shape = (n_poses, 3)
-                    # reprojection_error.shape = (n_poses,)
-                rvecs.append(rvec)
-                tvecs.append(tvec)
-                reprojection_errors.append(reprojection_error)
-            rvecs = np.array(rvecs)
-            tvecs = np.array(tvecs)
-            reprojection_errors = np.array(reprojection_errors)
+            rvecs, tvecs, reprojection_errors = \
+                _estimate_aruco_poses(corners, aruco_sizes, K, D, n_poses,
+                    ids=ids[:, 0], init_poses=init_poses)
             # rvecs.shape = (n, n_poses, 3)
             # tvecs.shape = (n, n_poses, 3)
             # reprojection_errors.shape = (n, n_poses)
@@ -262,26 +471,203 @@ def detect_aruco(image, K=None, D=None, aruco_sizes=None, use_generic=False,
             tvecs = np.empty((0, n_poses, 3))
             reprojection_errors = np.empty((0, n_poses))
     else:
-        n_poses = -1
         aruco_sizes = None
         rvecs = None
         tvecs = None
         reprojection_errors = None
 
-    arucos = ArucoList()
-    arucos.n = n
-    arucos.corners = corners
-    arucos.ids = ids
-    arucos.n_rejected = n_rejected
-    arucos.rejected = rejected
-    arucos.aruco_sizes = aruco_sizes
-    arucos.n_poses = n_poses
-    arucos.rvecs = rvecs
-    arucos.tvecs = tvecs
-    arucos.reprojection_errors = reprojection_errors
+    arucos = ArucoList.from_arrays(ids, corners, rejected, aruco_sizes=aruco_sizes,
+        rvecs=rvecs, tvecs=tvecs, reprojection_errors=reprojection_errors)
     return arucos
 
 
+class ArucoTracker:
+    # Tracks aruco markers in video frames. Markers are searched only in areas
+    # around their corners predicted from previous frames with constant velocity,
+    # all areas are detected in one mosaic image. Whole frame detection runs
+    # every redetection_period frames and when any tracked marker is lost.
+    # Single poses of tracked markers are refined from poses in the previous frame.
+    # Rejected candidates are returned only for whole frame detections.
+
+    def __init__(self, K=None, D=None, aruco_sizes=None, use_generic=False,
+            redetection_period=30, roi_margin=0.5, subpix_window_size=None,
+            aruco_dict=cv2.aruco.Dictionary_get(cv2.aruco.DICT_5X5_1000),
+            params=cv2.aruco.DetectorParameters_create()):
+        # aruco_sizes: size of all markers or dict with sizes by marker ids,
+        #     poses of markers with ids missing in dict are NaN
+        # roi_margin: margin of search area around predicted marker
+        #     relative to marker size in pixels
+        # subpix_window_size: half of window size for cv2.cornerSubPix(), None to disable
+        self.K = K
+        self.D = D
+        self.aruco_sizes = aruco_sizes
+        self.use_generic = use_generic
+        self.redetection_period = redetection_period
+        self.roi_margin = roi_margin
+        self.subpix_window_size = subpix_window_size
+        self.aruco_dict = aruco_dict
+        self.params = params
+
+        self.full_detections_counter = 0
+        self.reset()
+
+    def reset(self):
+        self.arucos = None
+        self._corners = dict()  # corners in the last frame by marker ids
+        self._velocities = dict()  # corners shifts in the last frame by marker ids
+        self._frames_since_detection = 0
+
+    def track(self, image):
+        corners, ids, rejected = None, None, list()
+        if len(self._corners) > 0 and self._frames_since_detection < self.redetection_period:
+            corners, ids = self._detect_in_predicted_areas(image)
+            if corners is not None:
+                self._frames_since_detection += 1
+        if corners is None:
+            corners, ids, rejected = \
+                cv2.aruco.detectMarkers(image, self.aruco_dict, parameters=self.params)
+            corners = np.array(corners, dtype=np.float32).reshape(-1, 4, 2)
+            ids = np.array(ids if ids is not None else [], dtype=np.int32).reshape(-1)
+            rejected = list(rejected)
+            self._frames_since_detection = 0
+            self.full_detections_counter += 1
+
+        if self.subpix_window_size is not None and len(corners) > 0:
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+            refined = cv2.cornerSubPix(gray, corners.reshape(-1, 1, 2).copy(),
+                (self.subpix_window_size, self.subpix_window_size), (-1, -1),
+                (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01))
+            corners = refined.reshape(-1, 4, 2)
+
+        self._update_motion(corners, ids)
+        init_poses = None
+        if self.arucos is not None and self.arucos.rvecs is not None and \
+                self.arucos.n_poses == 1:
+            init_poses = {aruco_id: (rvec[0], tvec[0]) for aruco_id, rvec, tvec in
+                zip(self.arucos.ids[:, 0], self.arucos.rvecs, self.arucos.tvecs)
+                if np.all(np.isfinite(rvec))}
+        self.arucos = _build_aruco_list(list(corners[:, np.newaxis]),
+            ids[:, np.newaxis] if len(ids) > 0 else None, rejected,
+            K=self.K, D=self.D, aruco_sizes=self.aruco_sizes,
+            use_generic=self.use_generic, init_poses=init_poses)
+        return self.arucos
+
+    def _detect_in_predicted_areas(self, image):
+        # returns corners (shape - (n, 4, 2)) and ids (shape - (n,))
+        # or None if any tracked marker is lost
+        tracked_ids = np.array(list(self._corners.keys()))
+        predicted = np.array([self._corners[aruco_id] + self._velocities.get(aruco_id, 0)
+            for aruco_id in tracked_ids])
+        min_xy = predicted.min(axis=1)
+        max_xy = predicted.max(axis=1)
+        margins = (max_xy - min_xy).max(axis=1, keepdims=True) * self.roi_margin
+        image_wh = np.array([image.shape[1], image.shape[0]])
+        boxes = np.hstack((
+            np.clip(np.floor(min_xy - margins), 0, image_wh),
+            np.clip(np.ceil(max_xy + margins), 0, image_wh))).astype(int)
+        if np.any((boxes[:, 2] <= boxes[:, 0]) | (boxes[:, 3] <= boxes[:, 1])):
+            return None, None
+
+        boxes, _ = _merge_boxes(boxes)
+        crops = [image[from_y:to_y, from_x:to_x] for from_x, from_y, to_x, to_y in boxes]
+        mosaic, offsets = _build_mosaic(crops, _MOSAIC_PADDING)
+        mosaic_corners, mosaic_ids, _ = \
+            cv2.aruco.detectMarkers(mosaic, self.aruco_dict, parameters=self.params)
+        if len(mosaic_corners) == 0:
+            return None, None
+        corners, _, in_crop = _map_from_mosaic(
+            np.array(mosaic_corners)[:, 0], crops, offsets, boxes, 1)
+        ids = mosaic_ids[in_crop, 0]
+
+        # marker can be found in several not merged areas
+        ids, unique_indices = np.unique(ids, return_index=True)
+        corners = corners[unique_indices].astype(np.float32)
+        if not np.all(np.isin(tracked_ids, ids)):
+            return None, None
+        return corners, ids
+
+    def _update_motion(self, corners, ids):
+        velocities = dict()
+        for aruco_id, aruco_corners in zip(ids, corners):
+            if aruco_id in self._corners:
+                velocities[aruco_id] = aruco_corners - self._corners[aruco_id]
+        self._velocities = velocities
+        self._corners = dict(zip(ids, corners))
+
+
+@lru_cache(maxsize=64)
+def _get_aruco_object_points(aruco_size):
+    # corners of aruco marker in marker frame, same order as detected corners
+    obj = np.array([
+        [-aruco_size / 2,  aruco_size / 2, 0],
+        [ aruco_size / 2,  aruco_size / 2, 0],
+        [ aruco_size / 2, -aruco_size / 2, 0],
+        [-aruco_size / 2, -aruco_size / 2, 0]])
+    obj.setflags(write=False)
+    return obj
+
+
+def _estimate_aruco_poses(corners, aruco_sizes, K, D, n_poses, ids=None, init_poses=None):
+    # corners.shape = (n, 1, 4, 2)
+    # aruco_sizes.shape = (n,)
+    # init_poses: dict with (rvec, tvec) by marker ids, single pose markers
+    #     with initial guess are refined iteratively from it
+    # Poses of markers with NaN size are NaN.
+    n = len(corners)
+    rvecs = np.full((n, n_poses, 3), np.nan)
+    tvecs = np.full((n, n_poses, 3), np.nan)
+    reprojection_errors = np.full((n, n_poses), -1.)  # undefined for single pose
+    for i in range(n):
+        if not np.isfinite(aruco_sizes[i]):
+            reprojection_errors[i] = np.nan
+            continue
+        obj = _get_aruco_object_points(float(aruco_sizes[i]))
+        if n_poses == 1 and init_poses is not None and ids[i] in init_poses:
+            init_rvec, init_tvec = init_poses[ids[i]]
+            _, rvec, tvec = cv2.solvePnP(obj, corners[i], K, D,
+                init_rvec.reshape(3, 1).copy(), init_tvec.reshape(3, 1).copy(),
+                useExtrinsicGuess=True, flags=cv2.SOLVEPNP_ITERATIVE)
+            rvecs[i, 0] = rvec[:, 0]
+            tvecs[i, 0] = tvec[:, 0]
+        elif n_poses == 1:
+            _, rvec, tvec = cv2.solvePnP(obj, corners[i], K, D,
+                flags=cv2.SOLVEPNP_IPPE_SQUARE)
+            rvecs[i, 0] = rvec[:, 0]
+            tvecs[i, 0] = tvec[:, 0]
+        else:
+            _, rvec, tvec, reprojection_error = \
+                cv2.solvePnPGeneric(obj, corners[i], K, D,
+                    flags=cv2.SOLVEPNP_IPPE_SQUARE,
+                    reprojectionError=np.empty(0, dtype=float))
+            assert len(rvec) == n_poses
+            rvecs[i] = np.array(rvec).reshape(n_poses, 3)
+            tvecs[i] = np.array(tvec).reshape(n_poses, 3)
+            reprojection_errors[i] = reprojection_error.reshape(n_poses)
+    # rvecs.shape = (n, n_poses, 3)
+    # tvecs.shape = (n, n_poses, 3)
+    # reprojection_errors.shape = (n, n_poses)
+    return rvecs, tvecs, reprojection_errors
+
+
+def _rodrigues(rvecs):
+    # Same as cv2.Rodrigues() for rotation vectors of shape (..., 3).
+    # Returns rotation matrices of shape (..., 3, 3).
+    angles = np.linalg.norm(rvecs, axis=-1)
+    small = angles < 1e-12
+    axes = rvecs / np.where(small, 1., angles)[..., np.newaxis]
+    axes[small] = 0
+    K = np.zeros(rvecs.shape[:-1] + (3, 3))
+    K[..., 0, 1] = -axes[..., 2]
+    K[..., 0, 2] = axes[..., 1]
+    K[..., 1, 0] = axes[..., 2]
+    K[..., 1, 2] = -axes[..., 0]
+    K[..., 2, 0] = -axes[..., 1]
+    K[..., 2, 1] = axes[..., 0]
+    sin = np.sin(angles)[..., np.newaxis, np.newaxis]
+    cos = np.cos(angles)[..., np.newaxis, np.newaxis]
+    return np.eye(3) + sin * K + (1 - cos) * np.matmul(K, K)
+
+
 def get_aruco_corners_3d(arucos: ArucoList):
     if any(getattr(arucos, attr) is None for attr in ('aruco_sizes', 'rvecs', 'tvecs')):
         return None
@@ -293,35 +679,16 @@ def get_aruco_corners_3d(arucos: ArucoList):
     tvecs = arucos.tvecs
 
     if n != 0:
-        marker_poses = np.tile(np.eye(4), (n, n_poses, 1, 1))
-        for i in range(n):
-            for j in range(n_poses):
-                marker_poses[i, j, 0:3, 0:3], _ = cv2.Rodrigues(rvecs[i, j])
-                marker_poses[i, j, 0:3, 3] = tvecs[i, j]
-        # marker_poses.shape = (n, n_poses, 4, 4)
-
-        corners_3d_in_marker_frames = list()
-        for i in range(n):
-            corners_3d_in_single_marker_frame = list()
-            aruco_size = aruco_sizes[i]
-            for sx, sy in [(-1, 1), (1, 1), (1, -1), (-1, -1)]:
-                single_corner_3d_in_marker_frame = np.array([
-                    aruco_size / 2 * sx,
-                    aruco_size / 2 * sy,
-                    0, 1]).reshape(4, 1)
-                corners_3d_in_single_marker_frame.append(single_corner_3d_in_marker_frame)
-            corners_3d_in_single_marker_frame = np.array(corners_3d_in_single_marker_frame)
-            corners_3d_in_marker_frames.append(corners_3d_in_single_marker_frame)
-        corners_3d_in_marker_frames = np.array(corners_3d_in_marker_frames)
-        # corners_3d_in_marker_frames.shape = (n, 4, 4, 1)
+        R = _rodrigues(rvecs)
+        # R.shape = (n, n_poses, 3, 3)
 
         corners_3d_in_marker_frames = \
-            np.expand_dims(corners_3d_in_marker_frames.swapaxes(0, 1), axis=2)
-        # corners_3d_in_marker_frames.shape = (4, n, 1, 4, 1)
+            np.array([[-1, 1, 0], [1, 1, 0], [1, -1, 0], [-1, -1, 0]]) * \
+            (aruco_sizes / 2)[:, np.newaxis, np.newaxis]
+        # corners_3d_in_marker_frames.shape = (n, 4, 3)
 
-        corners_3d = np.matmul(marker_poses, corners_3d_in_marker_frames)
-        corners_3d = corners_3d[:, :, :, 0:3, 0].transpose(1, 2, 0, 3)
-        # corners_3d.shape = (n, n_poses, 4, 3)
+        corners_3d = np.einsum('npij,nkj->npki', R, corners_3d_in_marker_frames) + \
+            tvecs[:, :, np.newaxis, :]
     else:
         corners_3d = np.empty((0, n_poses, 4, 3))
 
@@ -330,54 +697,31 @@ def get_aruco_corners_3d(arucos: ArucoList):
 
 
 def select_aruco_poses(arucos: ArucoList, selector):
+    # selector: one of PoseSelectors or function with the same signature
     assert arucos.n_poses > 0
 
     n = arucos.n
-    if n == 0:
-        selected_arucos = deepcopy(arucos)
-        selected_arucos.n_poses = 1
-        selected_arucos.rvecs = np.empty((0, 1, 3))
-        selected_arucos.tvecs = np.empty((0, 1, 3))
-        selected_arucos.reprojection_errors = np.empty((0, 1, 3))
-        return selected_arucos
-
-    rvecs = arucos.rvecs
-    tvecs = arucos.tvecs
-    reprojection_errors = arucos.reprojection_errors
-    selected = list()
-    for i in range(n):
-        s = selector(rvecs[i], tvecs[i], reprojection_errors[i])
-        selected.append(s)
+    if n != 0:
+        selected = np.asarray(selector(
+            arucos.rvecs, arucos.tvecs, arucos.reprojection_errors)).reshape(n, 1)
+    else:
+        selected = np.empty((0, 1), dtype=int)
 
-    selected = np.array(selected).reshape(n, 1, 1)
-    selected_arucos = deepcopy(arucos)
-    selected_arucos.n_poses = 1
-    selected_arucos.rvecs = np.take_along_axis(rvecs, selected, axis=1)
-    selected_arucos.tvecs = np.take_along_axis(tvecs, selected, axis=1)
-    selected_arucos.reprojection_errors = \
-        np.take_along_axis(reprojection_errors, selected.reshape(n, 1), axis=1)
-    return selected_arucos
+    data = arucos.data
+    selected_data = np.empty(n, dtype=_get_aruco_dtype(1))
+    for name in ('id', 'corners', 'size'):
+        selected_data[name] = data[name]
+    selected_data['rvec'] = np.take_along_axis(data['rvec'], selected[:, :, np.newaxis], axis=1)
+    selected_data['tvec'] = np.take_along_axis(data['tvec'], selected[:, :, np.newaxis], axis=1)
+    selected_data['error'] = np.take_along_axis(data['error'], selected, axis=1)
+    return ArucoList(selected_data, arucos.rejected, 1)
 
 
 def select_aruco_markers(arucos: ArucoList, accepter):
-    n = arucos.n
-    ids = arucos.ids
-    selected = list()
-    for i in range(n):
-        accept = accepter(ids[i])
-        if accept:
-            selected.append(i)
-
-    selected_arucos = deepcopy(arucos)
-    selected_arucos.n = len(selected)
-    selected_arucos.corners = selected_arucos.corners[selected]
-    selected_arucos.ids = selected_arucos.ids[selected]
-    if selected_arucos.n_poses > 0:
-        selected_arucos.aruco_sizes = selected_arucos.aruco_sizes[selected]
-        selected_arucos.rvecs = selected_arucos.rvecs[selected]
-        selected_arucos.tvecs = selected_arucos.tvecs[selected]
-        selected_arucos.reprojection_errors = selected_arucos.reprojection_errors[selected]
-    return selected_arucos
+    # accepter: function taking id of a marker (shape - (1,)) and returning True to keep it
+    accepted = np.fromiter((bool(accepter(aruco_id)) for aruco_id in arucos.ids),
+        dtype=bool, count=arucos.n)
+    return ArucoList(arucos.data[accepted], arucos.rejected, arucos.n_poses)
 
 
 def draw_aruco(image, arucos: ArucoList, draw_rejected_only=False,
@@ -390,46 +734,130 @@ def draw_aruco(image, arucos: ArucoList, draw_rejected_only=False,
     if draw_rejected_only:
         cv2.aruco.drawDetectedMarkers(image, arucos.rejected)
     else:
+        corners = np.ascontiguousarray(arucos.corners)
         if draw_ids:
-            cv2.aruco.drawDetectedMarkers(image, arucos.corners, arucos.ids)
+            cv2.aruco.drawDetectedMarkers(image, corners, np.ascontiguousarray(arucos.ids))
         else:
-            cv2.aruco.drawDetectedMarkers(image, arucos.corners)
+            cv2.aruco.drawDetectedMarkers(image, corners)
         if all(item is not None for item in (arucos.aruco_sizes, K, D)):
             for i in range(arucos.n):
+                if not np.isfinite(arucos.aruco_sizes[i]):
+                    continue
                 cv2.drawFrameAxes(image, K, D,
                     arucos.rvecs[i], arucos.tvecs[i], arucos.aruco_sizes[i] / 2)
     return image
 
 
-def detect_aruco_common(images_files, K, D, aruco_size, out_folder):
-    os.makedirs(out_folder, exist_ok=True)
-
-    aruco_dict = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_1000)
-    params = cv2.aruco.DetectorParameters_create()
-    for image_file in images_files:
-        image = cv2.imread(image_file)
-        arucos = detect_aruco(image, K=K, D=D, aruco_sizes=aruco_size,
-            use_generic=False, aruco_dict=aruco_dict, params=params)
-
-        n = arucos.n
-        print(f"{image_file} : detected {n} marker{'' if n == 1 else 's'}")
-
-        draw = draw_aruco(image.copy(), arucos, K=K, D=D)
-        draw_image_file = osp.join(
-            out_folder, Path(image_file).stem + '_vis.jpg')
-        cv2.imwrite(draw_image_file, draw)
+# state of detection worker process, see _init_detection_worker()
+_detection_worker = dict()
+
+
+def _init_detection_worker(K, D, aruco_size, out_folder, visualize, return_draw):
+    # aruco dictionary and detector parameters can not be pickled,
+    # so every worker creates its own
+    _detection_worker['aruco_dict'] = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_1000)
+    _detection_worker['params'] = cv2.aruco.DetectorParameters_create()
+    _detection_worker['K'] = K
+    _detection_worker['D'] = D
+    _detection_worker['aruco_size'] = aruco_size
+    _detection_worker['out_folder'] = out_folder
+    _detection_worker['visualize'] = visualize
+    _detection_worker['return_draw'] = return_draw
+
+
+def _detect_aruco_file(image_file):
+    # returns results of the image and visualization if it is not written by the worker
+    K = _detection_worker['K']
+    D = _detection_worker['D']
+    image = cv2.imread(image_file)
+    if image is None:
+        raise RuntimeError(f"Could not read image {image_file}")
+    arucos = detect_aruco(image, K=K, D=D, aruco_sizes=_detection_worker['aruco_size'],
+        use_generic=False, aruco_dict=_detection_worker['aruco_dict'],
+        params=_detection_worker['params'])
+    result = {
+        "image": image_file,
+        "ids": arucos.ids[:, 0].astype(int).tolist(),
+        "corners": arucos.corners[:, 0].tolist(),
+        "rvecs": arucos.rvecs[:, 0].tolist(),
+        "tvecs": arucos.tvecs[:, 0].tolist()}
+
+    draw = None
+    if _detection_worker['visualize']:
+        draw = draw_aruco(image, arucos, K=K, D=D)
+        if not _detection_worker['return_draw']:
+            draw_image_file = osp.join(_detection_worker['out_folder'],
+                Path(image_file).stem + '_vis.jpg')
+            cv2.imwrite(draw_image_file, draw)
+            draw = None
+    return result, draw
+
+
+def detect_aruco_common(images_files, K, D, aruco_size, out_folder=None, out_video_file=None,
+        visualize=True, results_file=None, jobs=1):
+    # out_folder: folder for visualization images, used if out_video_file is not set
+    # jobs: number of worker processes, images are reported in the input order
+    if visualize and out_video_file:
+        video_sink = VideoSink(out_video_file, drop_policy=VideoSink.BLOCK)
+    else:
+        video_sink = None
+        if visualize:
+            if not out_folder:
+                raise RuntimeError("Set out_folder or out_video_file to save visualization")
+            os.makedirs(out_folder, exist_ok=True)
+
+    init_args = (K, D, aruco_size, out_folder, visualize, video_sink is not None)
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs,
+            initializer=_init_detection_worker, initargs=init_args)
+        detections = pool.imap(_detect_aruco_file, images_files,
+            chunksize=max(min(len(images_files) // (jobs * 4), 16), 1))
+    else:
+        pool = None
+        _init_detection_worker(*init_args)
+        detections = map(_detect_aruco_file, images_files)
+
+    results = list()
+    try:
+        for result, draw in detections:
+            n = len(result["ids"])
+            print(f"{result['image']} : detected {n} marker{'' if n == 1 else 's'}")
+            if video_sink is not None:
+                video_sink.write(draw)
+            results.append(result)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if video_sink is not None:
+            video_sink.close()
+
+    if results_file:
+        with open(results_file, 'w') as f:
+            json.dump(results, f)
+    return results
 
 
 if __name__ == "__main__":
     parser = build_parser()
     args = parser.parse_args()
+    if args.no_visualization:
+        if args.out_folder or args.out_video_file:
+            parser.error("-out-fld and -out-video can not be used with -no-vis")
+    elif not args.out_folder and not args.out_video_file:
+        parser.error("set -out-fld or -out-video to save visualization, or use -no-vis")
+    if args.jobs < 1:
+        parser.error("-j must be positive")
 
     images_files = glob.glob(args.images_folder + f"/*.{args.images_extension}")
     images_files = sorted(images_files)
-    assert len(images_files) != 0
+    if len(images_files) == 0:
+        parser.error(f"no .{args.images_extension} images in {args.images_folder}")
 
     camera_calibration = np.load(args.camera_calibration)
     K = camera_calibration['K']
     D = camera_calibration['D']
 
-    detect_aruco_common(images_files, K, D, args.aruco_size, args.out_folder)
+    detect_aruco_common(images_files, K, D, args.aruco_size, args.out_folder,
+        out_video_file=args.out_video_file, visualize=(not args.no_visualization),
+        results_file=args.results_file, jobs=args.jobs)
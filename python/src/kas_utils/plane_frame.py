@@ -1,4 +1,8 @@
 import numpy as np
+from collections import deque
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 
 class PlaneFrame():
@@ -18,6 +22,12 @@ class PlaneFrame():
         obj.set_from_points(points)
         return obj
 
+    @classmethod
+    def from_points_robust(cls, points, **kwargs):
+        obj = cls()
+        inliers = obj.set_from_points_robust(points, **kwargs)
+        return obj, inliers
+
     def set(self, T):
         assert isinstance(T, np.ndarray)
         assert T.shape == (4, 4)
@@ -49,26 +59,22 @@ class PlaneFrame():
             self.orthogonal_distance_from_origin(points)
         return dist
 
-    def to_plane(self, data_in_origin, is_poses=False, shift=0):
+    def to_plane(self, data_in_origin, is_poses=False, shift=0, out=None):
+        # data_in_origin.shape = (..., 3) or (..., 4) for points, (..., 4, 4) for poses
+        # out: optional array to store the result in, can be data_in_origin itself
         assert self.is_set()
-        data_in_origin, is_padded = \
-            self._prepare_data_for_processing(data_in_origin, is_poses)
         shifted_invT = self.invT.copy()
         shifted_invT[2, 3] -= shift
-        data_in_plane = np.matmul(shifted_invT, data_in_origin)
-        data_in_plane = \
-            self._prepare_data_for_return(data_in_plane, is_poses, is_padded)
+        data_in_plane = self._transform(shifted_invT, data_in_origin, is_poses, out)
         return data_in_plane
 
-    def to_origin(self, data_in_plane, is_poses=False, shift=0):
+    def to_origin(self, data_in_plane, is_poses=False, shift=0, out=None):
+        # data_in_plane.shape = (..., 3) or (..., 4) for points, (..., 4, 4) for poses
+        # out: optional array to store the result in, can be data_in_plane itself
         assert self.is_set()
-        data_in_plane, is_padded = \
-            self._prepare_data_for_processing(data_in_plane, is_poses)
         shifted_T = self.T.copy()
         shifted_T[:3, 3] += self.T[:3, 2] * shift
-        data_in_origin = np.matmul(shifted_T, data_in_plane)
-        data_in_origin = \
-            self._prepare_data_for_return(data_in_origin, is_poses, is_padded)
+        data_in_origin = self._transform(shifted_T, data_in_plane, is_poses, out)
         return data_in_origin
 
     def project_points(self, points, shift=0):
@@ -95,29 +101,95 @@ class PlaneFrame():
         # A = [[xi, yi, 1]]
         # B = [zi]
 
-        # plane = inv(AT * A) * AT * B
-
         n = points.shape[0]
-        assert n % 2 == 0
+        assert n >= 3
 
         A = np.hstack((points[:, 0:2], np.ones((n, 1))))
         B = points[:, 2]
-        plane = np.matmul(np.matmul(np.linalg.inv(np.matmul(A.T, A)), A.T), B)
-
-        centroid = np.sum(points, axis=0) / n
-        origin = self._project_to_plane(centroid, plane)
+        plane, _, _, _ = np.linalg.lstsq(A, B, rcond=None)
 
         a = plane[0]
         b = plane[1]
         c = plane[2]
-        z_axis = np.array([-a, -b, 1])
-        z_axis /= np.linalg.norm(z_axis)
+        norm = np.linalg.norm([-a, -b, 1])
+        normal = np.array([-a, -b, 1]) / norm
+        distance = c / norm
+        self._set_from_plane(normal, distance, points)
+
+    def set_from_points_robust(self, points, distance_threshold=0.01,
+            num_hypotheses=256, max_samples=10000, refine_iterations=2,
+            sampling_radius=None, seed=None):
+        # MSAC: plane hypotheses from random triplets are scored all at once on
+        # a random subsample of points, the best one is refined by total least squares
+        # on its inliers. Unlike set_from_points(), vertical planes are supported.
+        # sampling_radius: if set, triplets are sampled from neighborhoods of this radius,
+        #     which helps when the plane is a small part of the points.
+        # Returns inliers mask, shape - (n,).
+
+        n = points.shape[0]
+        assert n >= 3
+        rng = np.random.default_rng(seed)
 
+        if n > max_samples:
+            samples = points[rng.choice(n, max_samples, replace=False)]
+        else:
+            samples = points
+        samples = samples.astype(np.float64)
+
+        if sampling_radius is None:
+            triplets = samples[rng.integers(0, len(samples), size=(num_hypotheses, 3))]
+        else:
+            centers = rng.integers(0, len(samples), size=(num_hypotheses,))
+            neighbors = cKDTree(samples).query_ball_point(samples[centers], sampling_radius)
+            neighbors_nums = np.array([len(center_neighbors) for center_neighbors in neighbors])
+            picks = (rng.random((num_hypotheses, 2)) * neighbors_nums[:, np.newaxis]).astype(int)
+            triplets_indices = np.empty((num_hypotheses, 3), dtype=int)
+            triplets_indices[:, 0] = centers
+            for i, (center_neighbors, (pick_1, pick_2)) in enumerate(zip(neighbors, picks)):
+                triplets_indices[i, 1] = center_neighbors[pick_1]
+                triplets_indices[i, 2] = center_neighbors[pick_2]
+            triplets = samples[triplets_indices]
+        normals = np.cross(triplets[:, 1] - triplets[:, 0], triplets[:, 2] - triplets[:, 0])
+        norms = np.linalg.norm(normals, axis=1)
+        valid = norms > 1e-9
+        if not np.any(valid):
+            raise RuntimeError("Could not fit plane: all hypotheses are degenerate")
+        normals = normals[valid] / norms[valid, np.newaxis]
+        distances = np.sum(normals * triplets[valid, 0], axis=1)
+
+        # residuals.shape = (n_samples, n_hypotheses)
+        residuals = np.abs(np.matmul(samples, normals.T) - distances)
+        costs = np.minimum(residuals, distance_threshold).sum(axis=0)
+        best = np.argmin(costs)
+        normal = normals[best]
+        distance = distances[best]
+
+        for _ in range(refine_iterations + 1):
+            inliers = np.abs(np.matmul(points, normal) - distance) < distance_threshold
+            if np.count_nonzero(inliers) < 3:
+                raise RuntimeError("Could not fit plane: not enough inliers")
+            normal, distance = self._fit_plane_svd(points[inliers])
+        inliers = np.abs(np.matmul(points, normal) - distance) < distance_threshold
+
+        self._set_from_plane(normal, distance, points[inliers])
+        return inliers
+
+    def _set_from_plane(self, normal, distance, points):
+        # plane: dot(normal, p) = distance, normal is unit length
+        n = points.shape[0]
+        centroid = np.sum(points, axis=0) / n
         x_direction = \
-            (np.sum(points[:int(n/2)], axis=0) / (n/2) +
-            2 * centroid - np.sum(points[int(n/2):], axis=0) / (n/2)) / 2
-        x_axis = self._project_to_plane(x_direction, plane) - origin
-        x_axis /= np.linalg.norm(x_axis)
+            np.sum(points[:n // 2], axis=0) / (n // 2) - \
+            np.sum(points[n // 2:], axis=0) / (n - n // 2)
+        self._set_from_centroid(normal, distance, centroid, x_direction)
+
+    def _set_from_centroid(self, normal, distance, centroid, x_direction):
+        # origin is centroid projected onto the plane,
+        # x axis is x_direction projected onto the plane
+        origin = centroid - (np.dot(normal, centroid) - distance) * normal
+
+        z_axis = normal.astype(np.float64)
+        x_axis = self._project_x_axis(x_direction, z_axis)
         y_axis = np.cross(z_axis, x_axis)
         y_axis /= np.linalg.norm(y_axis)
 
@@ -125,59 +197,248 @@ class PlaneFrame():
             y_axis *= -1
             z_axis *= -1
 
-        x_axis = np.expand_dims(x_axis, axis=-1)
-        y_axis = np.expand_dims(y_axis, axis=-1)
-        z_axis = np.expand_dims(z_axis, axis=-1)
-
-        R = np.hstack((x_axis, y_axis, z_axis))
+        R = np.stack((x_axis, y_axis, z_axis), axis=1)
         T = np.eye(4)
         T[0:3, 0:3] = R
         T[0:3, 3] = origin
         self.set(T)
 
     @staticmethod
-    def _project_to_plane(p0, plane):
-        x0 = p0[0]
-        y0 = p0[1]
-        z0 = p0[2]
-        a = plane[0]
-        b = plane[1]
-        c = plane[2]
+    def _project_x_axis(x_direction, z_axis):
+        # unit x axis from x_direction projected onto the plane,
+        # any axis in the plane if x_direction is parallel to z_axis or not finite
+        x_axis = x_direction - np.dot(x_direction, z_axis) * z_axis
+        norm = np.linalg.norm(x_axis)
+        if not np.isfinite(norm) or norm < 1e-9:
+            x_axis = np.cross(z_axis, np.eye(3)[np.argmin(np.abs(z_axis))])
+        x_axis /= np.linalg.norm(x_axis)
+        return x_axis
 
-        dz = (a * x0 + b * y0 + c - z0) / (a * a + b * b + 1)
-        x = x0 - a * dz
-        y = y0 - b * dz
-        z = z0 + dz
-        return np.array([x, y, z])
+    @staticmethod
+    def _fit_plane_svd(points):
+        # total least squares plane: dot(normal, p) = distance
+        centroid = np.mean(points, axis=0, dtype=np.float64)
+        centered = points - centroid
+        scatter = np.matmul(centered.T, centered)
+        _, _, vt = np.linalg.svd(scatter)
+        normal = vt[2]
+        distance = np.dot(normal, centroid)
+        return normal, distance
 
     @staticmethod
-    def _prepare_data_for_processing(data, is_poses):
-        if not is_poses:
-            assert data.shape[-1] in (3, 4)
-        else:
+    def _transform(T, data, is_poses, out):
+        if is_poses:
             assert data.shape[-2:] == (4, 4)
-
-        if not is_poses:
-            if data.shape[-1] == 3:
-                pad_width = [(0, 0)] * data.ndim
-                pad_width[-1] = (0, 1)
-                data = np.pad(data, pad_width, mode='constant', constant_values=1)
-                is_padded = True
-            elif data.shape[-1] == 4:
-                is_padded = False
-            data = np.expand_dims(data, axis=-1)
-            # data.shape = (..., 4, 1)
+            return np.matmul(T, data, out=out)
+
+        assert data.shape[-1] in (3, 4)
+        # apply R * p + t directly instead of padding points to homogeneous coordinates,
+        # float32 points stay float32
+        dtype = np.result_type(data.dtype, np.float32)
+        RT = T[:3, :3].T.astype(dtype)
+        t = T[:3, 3].astype(dtype)
+        if out is None:
+            out = np.empty(data.shape, dtype=dtype)
+        assert out.shape == data.shape
+
+        if data.shape[-1] == 3:
+            np.matmul(data, RT, out=out)
+            out += t
         else:
-            # data.shape = (..., 4, 4)
-            is_padded = None
+            np.matmul(data[..., :3], RT, out=out[..., :3])
+            out[..., :3] += data[..., 3:] * t
+            if out is not data:
+                out[..., 3] = data[..., 3]
+        return out
+
+
+class PlaneTracker:
+    # Tracks a plane across frames by keeping running sums of points and their products,
+    # so the plane is updated with new points only. Old points are either decayed
+    # (statistics are multiplied by decay on every update) or windowed
+    # (only the last window_size updates are kept).
+
+    def __init__(self, decay=0.9, window_size=None, distance_threshold=None):
+        # distance_threshold: if set, only points closer than distance_threshold
+        #     to the current plane are added
+        assert 0 < decay <= 1
+        assert window_size is None or window_size > 0
+
+        self.decay = decay
+        self.window_size = window_size
+        self.distance_threshold = distance_threshold
+
+        self.plane_frame = PlaneFrame()
+        self.reset()
+
+    def reset(self):
+        self.plane_frame = PlaneFrame()
+        self._count = 0.
+        self._sum = np.zeros((3,))
+        self._sum_outer = np.zeros((3, 3))
+        self._window = deque()
+
+    def update(self, points):
+        # returns inliers mask of the added points, shape - (n,)
+        points = np.asarray(points).reshape(-1, 3)
+        if self.distance_threshold is not None and self.plane_frame.is_set():
+            inliers = np.abs(self.plane_frame.distance_to_plane(points)) < self.distance_threshold
+            points = points[inliers]
+        else:
+            inliers = np.ones((len(points),), dtype=bool)
 
-        return data, is_padded
+        count = len(points)
+        points_sum = np.sum(points, axis=0, dtype=np.float64)
+        points_sum_outer = np.matmul(points.T.astype(np.float64), points)
 
-    @staticmethod
-    def _prepare_data_for_return(data, is_poses, is_padded):
-        if not is_poses:
-            data = data[..., 0]
-            if is_padded:
-                data = data[..., :3]
-        return data
+        if self.window_size is None:
+            self._count = self._count * self.decay + count
+            self._sum = self._sum * self.decay + points_sum
+            self._sum_outer = self._sum_outer * self.decay + points_sum_outer
+        else:
+            self._window.append((count, points_sum, points_sum_outer))
+            self._count += count
+            self._sum += points_sum
+            self._sum_outer += points_sum_outer
+            if len(self._window) > self.window_size:
+                old_count, old_sum, old_sum_outer = self._window.popleft()
+                self._count -= old_count
+                self._sum -= old_sum
+                self._sum_outer -= old_sum_outer
+
+        if self._count < 3:
+            return inliers
+
+        if not self.plane_frame.is_set():
+            # frame is built from accumulated statistics, the last update can have few points,
+            # x axis goes along the largest spread of points
+            centroid, vt = self._get_covariance_axes()
+            normal = vt[2]
+            self.plane_frame._set_from_centroid(normal, np.dot(normal, centroid), centroid, vt[0])
+        else:
+            self._update_plane_frame()
+        return inliers
+
+    def _get_covariance_axes(self):
+        centroid = self._sum / self._count
+        covariance = self._sum_outer / self._count - np.outer(centroid, centroid)
+        _, _, vt = np.linalg.svd(covariance)
+        return centroid, vt
+
+    def _get_plane(self):
+        centroid, vt = self._get_covariance_axes()
+        normal = vt[2]
+        distance = np.dot(normal, centroid)
+        return normal, distance
+    def _update_plane_frame(self):
+        # keep the frame stable: previous origin and x axis are projected onto the new plane
+        normal, distance = self._get_plane()
+        T = self.plane_frame.origin2plane()
+        prev_x_axis = T[:3, 0]
+        prev_z_axis = T[:3, 2]
+        prev_origin = T[:3, 3]
+
+        if np.dot(normal, prev_z_axis) < 0:
+            normal = -normal
+            distance = -distance
+        z_axis = normal
+        origin = prev_origin - (np.dot(z_axis, prev_origin) - distance) * z_axis
+        x_axis = PlaneFrame._project_x_axis(prev_x_axis, z_axis)
+        y_axis = np.cross(z_axis, x_axis)
 
+        T = np.eye(4)
+        T[0:3, 0:3] = np.stack((x_axis, y_axis, z_axis), axis=1)
+        T[0:3, 3] = origin
+        self.plane_frame.set(T)
+
+
+def extract_planes(points, voxel_size=0.02, distance_threshold=0.02,
+        max_planes=10, min_points=100, seed=None):
+    # Repeatedly extracts the largest plane from a point cloud.
+    # Planes are fitted on voxel downsampled points, and only the largest spatially
+    # connected part of every plane is taken, so coplanar but separated surfaces
+    # become different planes. Labels are back-projected to the full cloud at the end.
+    # min_points is the minimum number of voxels in a plane.
+    # Returns list of PlaneFrame and list of inliers indices, one per plane.
+
+    points = np.asarray(points).reshape(-1, 3)
+    if len(points) == 0:
+        return list(), list()
+    rng = np.random.default_rng(seed)
+
+    _, voxels_points, points_voxels = _voxel_down_sample(points, voxel_size)
+    voxels_labels = np.full((len(voxels_points),), -1)
+    tree = cKDTree(voxels_points)
+    pairs = tree.query_pairs(voxel_size * 1.8, output_type='ndarray')
+
+    remaining = np.arange(len(voxels_points))
+    # voxels of planes without large enough connected parts, they are not used
+    # to search for planes again, but can still become parts of other planes
+    tried = np.zeros((len(voxels_points),), dtype=bool)
+    plane_frames = list()
+    while len(plane_frames) < max_planes and len(remaining) >= min_points:
+        searched = remaining[~tried[remaining]]
+        if len(searched) < min_points:
+            break
+        plane_frame = PlaneFrame()
+        try:
+            inliers = plane_frame.set_from_points_robust(voxels_points[searched],
+                distance_threshold=distance_threshold, sampling_radius=voxel_size * 5,
+                seed=rng)
+        except RuntimeError:
+            break
+        if np.count_nonzero(inliers) < min_points:
+            break
+        candidates = remaining[np.abs(plane_frame.distance_to_plane(
+            voxels_points[remaining])) < distance_threshold]
+
+        # largest connected component of the plane inliers
+        is_candidate = np.zeros((len(voxels_points),), dtype=bool)
+        is_candidate[candidates] = True
+        candidates_pairs = pairs[is_candidate[pairs[:, 0]] & is_candidate[pairs[:, 1]]]
+        graph = coo_matrix(
+            (np.ones((len(candidates_pairs),)), (candidates_pairs[:, 0], candidates_pairs[:, 1])),
+            shape=(len(voxels_points), len(voxels_points)))
+        _, components = connected_components(graph, directed=False)
+        candidates_components = components[candidates]
+        largest = np.argmax(np.bincount(candidates_components))
+        plane_voxels = candidates[candidates_components == largest]
+        if len(plane_voxels) < min_points:
+            # plane consists of small separated surfaces only
+            tried[candidates] = True
+            continue
+
+        voxels_labels[plane_voxels] = len(plane_frames)
+        plane_frames.append(plane_frame)
+        remaining = remaining[voxels_labels[remaining] == -1]
+
+    # back-project labels to all points and refine planes on them
+    points_labels = voxels_labels[points_voxels]
+    planes_indices = list()
+    for label, plane_frame in enumerate(plane_frames):
+        indices = np.flatnonzero(points_labels == label)
+        normal, distance = PlaneFrame._fit_plane_svd(points[indices])
+        close = np.abs(np.matmul(points[indices], normal) - distance) < distance_threshold
+        indices = indices[close]
+        if len(indices) >= 3:
+            normal, distance = PlaneFrame._fit_plane_svd(points[indices])
+            plane_frame._set_from_plane(normal, distance, points[indices])
+        planes_indices.append(indices)
+    return plane_frames, planes_indices
+
+
+def _voxel_down_sample(points, voxel_size):
+    # returns voxels coordinates, mean points of voxels and voxel index of every point
+    voxels = np.floor(points / voxel_size).astype(np.int64)
+    voxels -= voxels.min(axis=0)
+    dims = voxels.max(axis=0) + 1
+    keys = (voxels[:, 0] * dims[1] + voxels[:, 1]) * dims[2] + voxels[:, 2]
+    _, first, points_voxels = np.unique(keys, return_index=True, return_inverse=True)
+    points_voxels = points_voxels.reshape(-1)
+    voxels = voxels[first]
+    counts = np.bincount(points_voxels, minlength=len(voxels))
+    voxels_points = np.empty((len(voxels), 3))
+    for i in range(3):
+        voxels_points[:, i] = np.bincount(points_voxels, weights=points[:, i],
+            minlength=len(voxels)) / counts
+    return voxels, voxels_points, points_voxels
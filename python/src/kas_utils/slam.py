@@ -1,82 +1,681 @@
 import open3d as o3d
 import numpy as np
+import threading
+import queue
+import os
+import os.path as osp
+import shutil
+import tempfile
+import weakref
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import time, monotonic
+from scipy.spatial import cKDTree
 from scipy.spatial.transform import Rotation
+from kas_utils.time_measurer import TimeMeasurer
+
+
+class VoxelMap:
+    # Voxel hashed point cloud. Every voxel keeps sums of points, normals and colors
+    # inserted into it, so frames can be both inserted and removed (inserted with
+    # negative weight). Voxels are stored in arrays sorted by voxel keys.
+
+    _KEY_BITS = 21
+    _KEY_OFFSET = 1 << (_KEY_BITS - 1)
+
+    def __init__(self, voxel_size):
+        self.voxel_size = voxel_size
+
+        self._keys = np.empty((0,), dtype=np.int64)
+        self._weights = np.empty((0,))
+        self._points_sums = np.empty((0, 3))
+        self._normals_sums = None
+        self._colors_sums = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def insert(self, points, normals=None, colors=None, weight=1.):
+        # points, normals, colors: shape - (n, 3)
+        # Returns sums added to voxels, they can be subtracted exactly
+        # with remove_sums() later.
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        if len(points) == 0:
+            return None
+        if normals is not None and self._normals_sums is None:
+            assert len(self._keys) == 0
+            self._normals_sums = np.empty((0, 3))
+        if colors is not None and self._colors_sums is None:
+            assert len(self._keys) == 0
+            self._colors_sums = np.empty((0, 3))
+        assert (normals is None) == (self._normals_sums is None)
+        assert (colors is None) == (self._colors_sums is None)
+
+        # aggregate inserted points per voxel
+        keys = self._get_keys(points)
+        keys, inverse = np.unique(keys, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        weights = np.bincount(inverse, minlength=len(keys)) * weight
+        points_sums = self._sum_by_voxel(inverse, points, len(keys)) * weight
+        normals_sums = self._sum_by_voxel(inverse, normals, len(keys)) * weight \
+            if normals is not None else None
+        colors_sums = self._sum_by_voxel(inverse, colors, len(keys)) * weight \
+            if colors is not None else None
+        sums = (keys, weights, points_sums, normals_sums, colors_sums)
+        self._add_sums(*sums)
+        return sums
+
+    def remove(self, points, normals=None, colors=None, weight=1.):
+        # removes previously inserted points
+        self.insert(points, normals=normals, colors=colors, weight=-weight)
+
+    def remove_sums(self, sums):
+        # removes sums returned by insert()
+        if sums is not None:
+            keys, *values = sums
+            self._add_sums(keys, *[-value if value is not None else None for value in values])
+
+    def _add_sums(self, keys, weights, points_sums, normals_sums, colors_sums):
+        # update existing voxels
+        positions = np.searchsorted(self._keys, keys)
+        existing = positions < len(self._keys)
+        existing[existing] = self._keys[positions[existing]] == keys[existing]
+        existing_positions = positions[existing]
+        self._weights[existing_positions] += weights[existing]
+        self._points_sums[existing_positions] += points_sums[existing]
+        if normals_sums is not None:
+            self._normals_sums[existing_positions] += normals_sums[existing]
+        if colors_sums is not None:
+            self._colors_sums[existing_positions] += colors_sums[existing]
+
+        # add new voxels
+        new = ~existing
+        if np.any(new):
+            new_positions = positions[new]
+            self._keys = np.insert(self._keys, new_positions, keys[new])
+            self._weights = np.insert(self._weights, new_positions, weights[new])
+            self._points_sums = np.insert(self._points_sums, new_positions, points_sums[new], axis=0)
+            if normals_sums is not None:
+                self._normals_sums = \
+                    np.insert(self._normals_sums, new_positions, normals_sums[new], axis=0)
+            if colors_sums is not None:
+                self._colors_sums = \
+                    np.insert(self._colors_sums, new_positions, colors_sums[new], axis=0)
+
+        if np.any(weights < 0):
+            self._remove_empty()
+
+    def clear(self):
+        self.__init__(self.voxel_size)
+
+    def get_points(self):
+        return self._points_sums / self._weights[:, np.newaxis]
+
+    def get_normals(self):
+        if self._normals_sums is None:
+            return None
+        norms = np.linalg.norm(self._normals_sums, axis=1, keepdims=True)
+        return self._normals_sums / np.maximum(norms, 1e-12)
+
+    def get_colors(self):
+        if self._colors_sums is None:
+            return None
+        return self._colors_sums / self._weights[:, np.newaxis]
+
+    def to_point_cloud(self):
+        pc = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(self.get_points()))
+        if self._normals_sums is not None:
+            pc.normals = o3d.utility.Vector3dVector(self.get_normals())
+        if self._colors_sums is not None:
+            pc.colors = o3d.utility.Vector3dVector(self.get_colors())
+        return pc
+
+    def _get_keys(self, points):
+        voxels = np.floor(points / self.voxel_size).astype(np.int64) + VoxelMap._KEY_OFFSET
+        assert np.all((voxels >= 0) & (voxels < (1 << VoxelMap._KEY_BITS)))
+        keys = (voxels[:, 0] << (2 * VoxelMap._KEY_BITS)) | \
+            (voxels[:, 1] << VoxelMap._KEY_BITS) | voxels[:, 2]
+        return keys
+
+    @staticmethod
+    def _sum_by_voxel(inverse, values, n):
+        values = np.asarray(values, dtype=np.float64)
+        sums = np.empty((n, values.shape[1]))
+        for i in range(values.shape[1]):
+            sums[:, i] = np.bincount(inverse, weights=values[:, i], minlength=n)
+        return sums
+
+    def _remove_empty(self):
+        keep = self._weights > 1e-6
+        if np.all(keep):
+            return
+        self._keys = self._keys[keep]
+        self._weights = self._weights[keep]
+        self._points_sums = self._points_sums[keep]
+        if self._normals_sums is not None:
+            self._normals_sums = self._normals_sums[keep]
+        if self._colors_sums is not None:
+            self._colors_sums = self._colors_sums[keep]
+
+
+class MapBuilder:
+    # Fuses frames into a VoxelMap as they come, so memory is proportional
+    # to the mapped volume rather than to the number of frames.
+    # Frames whose poses were corrected (e.g. by pose graph optimization)
+    # are removed and inserted again with the new pose. Voxel sums added by every frame
+    # are kept, so frames are removed exactly even if they are loaded again
+    # with lower precision (e.g. from KeyframeStore).
+
+    def __init__(self, voxel_size, translation_threshold=None, rotation_threshold=0.005):
+        # translation_threshold, rotation_threshold: frames are reinserted
+        #     if their poses change more. translation_threshold is voxel_size / 2 by default.
+        self.voxel_size = voxel_size
+        self.translation_threshold = translation_threshold \
+            if translation_threshold is not None else voxel_size / 2
+        self.rotation_threshold = rotation_threshold
+
+        self.voxel_map = VoxelMap(voxel_size)
+        self._poses = dict()  # poses frames were inserted with, key is frame id
+        self._sums = dict()  # voxel sums added by frames, key is frame id
+
+    def __len__(self):
+        # number of inserted frames
+        return len(self._poses)
+
+    def __contains__(self, i):
+        return i in self._poses
+
+    def is_outdated(self, i, pose):
+        # returns True if frame i is not inserted or was inserted with a different pose
+        if i not in self._poses:
+            return True
+        difference = np.matmul(np.linalg.inv(self._poses[i]), pose)
+        translation = np.linalg.norm(difference[:3, 3])
+        angle = np.linalg.norm(Rotation.from_matrix(difference[:3, :3]).as_rotvec())
+        return translation > self.translation_threshold or angle > self.rotation_threshold
+
+    def update(self, i, frame: o3d.geometry.PointCloud, pose):
+        # inserts frame i or reinserts it if its pose changed
+        # returns True if the map was changed
+        if not self.is_outdated(i, pose):
+            return False
+        if i in self._poses:
+            self.remove(i)
+        self._sums[i] = self._insert_frame(frame, pose)
+        self._poses[i] = np.array(pose)
+        return True
+
+    def remove(self, i):
+        del self._poses[i]
+        self.voxel_map.remove_sums(self._sums.pop(i))
+
+    def clear(self):
+        self.voxel_map.clear()
+        self._poses.clear()
+        self._sums.clear()
+
+    def to_point_cloud(self):
+        return self.voxel_map.to_point_cloud()
+
+    def _insert_frame(self, frame, pose):
+        points = _transform_points(np.asarray(frame.points), pose)
+        normals = np.matmul(np.asarray(frame.normals), pose[:3, :3].T) \
+            if frame.has_normals() else None
+        colors = np.asarray(frame.colors) if frame.has_colors() else None
+        return self.voxel_map.insert(points, normals=normals, colors=colors)
+
+
+class KeyframeStore:
+    # List of point clouds stored on disk as float32 .npy files (points, normals and colors).
+    # The last accessed cache_size point clouds are kept in memory. Can be used instead
+    # of a list of reference frames by ReferenceFrameOdometry and PoseGraph.
+
+    def __init__(self, folder=None, cache_size=16, load=False):
+        # folder: if None, a temporary folder is created and removed on close()
+        # load: if True, frames already stored in the folder are available,
+        #     otherwise the folder must not contain frames
+        if folder is None:
+            folder = tempfile.mkdtemp(prefix="keyframes_")
+            self._remove_folder = True
+        else:
+            os.makedirs(folder, exist_ok=True)
+            self._remove_folder = False
+        self.folder = folder
+        self.cache_size = cache_size
+
+        self._size = 0
+        while osp.isfile(self._get_file(self._size, "points")):
+            self._size += 1
+        if self._size > 0 and not load:
+            raise RuntimeError(f"Folder {folder} already contains keyframes, "
+                f"use load=True to load them")
+        self._cache = OrderedDict()
+        self._mutex = threading.Lock()  # guards _size and _cache
+        self._append_mutex = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for i in range(self._size):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._size
+        if i < 0 or i >= self._size:
+            raise IndexError(f"Keyframe index {i} out of range")
+        with self._mutex:
+            if i in self._cache:
+                self._cache.move_to_end(i)
+                return self._cache[i]
+        pc = self._load(i)
+        with self._mutex:
+            self._put_to_cache(i, pc)
+        return pc
+
+    def append(self, pc: o3d.geometry.PointCloud):
+        # the frame becomes available only after it is written
+        with self._append_mutex:
+            i = self._size
+            self._save(i, pc)
+            with self._mutex:
+                self._put_to_cache(i, pc)
+                self._size += 1
+
+    def close(self):
+        with self._mutex:
+            self._cache.clear()
+        if self._remove_folder and osp.isdir(self.folder):
+            shutil.rmtree(self.folder)
+
+    def _put_to_cache(self, i, pc):
+        self._cache[i] = pc
+        self._cache.move_to_end(i)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _get_file(self, i, field):
+        return osp.join(self.folder, f"{i:06d}_{field}.npy")
+
+    def _save(self, i, pc):
+        np.save(self._get_file(i, "points"), np.asarray(pc.points, dtype=np.float32))
+        if pc.has_normals():
+            np.save(self._get_file(i, "normals"), np.asarray(pc.normals, dtype=np.float32))
+        if pc.has_colors():
+            np.save(self._get_file(i, "colors"), np.asarray(pc.colors, dtype=np.float32))
+
+    def _load(self, i):
+        pc = o3d.geometry.PointCloud()
+        pc.points = o3d.utility.Vector3dVector(
+            np.load(self._get_file(i, "points")).astype(np.float64))
+        for field in ("normals", "colors"):
+            file = self._get_file(i, field)
+            if osp.isfile(file):
+                setattr(pc, field, o3d.utility.Vector3dVector(
+                    np.load(file).astype(np.float64)))
+        return pc
+
+    def __del__(self):
+        if hasattr(self, "_mutex"):
+            self.close()
+
+
+class RegistrationTarget:
+    # Target point cloud prepared for registration. Points, normals and KD-tree
+    # are built once and reused by all ICP stages and by all frames registered
+    # against the same target.
+
+    def __init__(self, pc: o3d.geometry.PointCloud):
+        self.pc = pc
+        self.points = np.asarray(pc.points)
+        self.normals = np.asarray(pc.normals) if pc.has_normals() else None
+        self.tree = cKDTree(self.points)
+
+    def find_correspondences(self, source_points, max_correspondence_distance):
+        # returns indices of corresponding source and target points and distances between them
+        distances, target_indices = self.tree.query(source_points,
+            distance_upper_bound=max_correspondence_distance, workers=-1)
+        source_indices = np.flatnonzero(np.isfinite(distances))
+        return source_indices, target_indices[source_indices], distances[source_indices]
+
+    def evaluate(self, source_points, max_correspondence_distance, transformation):
+        # same as o3d.pipelines.registration.evaluate_registration(), returns fitness and rmse
+        source_points = _transform_points(source_points, transformation)
+        _, _, distances = self.find_correspondences(source_points, max_correspondence_distance)
+        if len(distances) == 0:
+            return 0., 0.
+        fitness = len(distances) / len(source_points)
+        rmse = np.sqrt(np.mean(distances ** 2))
+        return fitness, rmse
+
+
+def _transform_points(points, transformation):
+    return np.matmul(points, transformation[:3, :3].T) + transformation[:3, 3]
+
+
+def _register_icp(source_points, target: RegistrationTarget, init_relative_pose,
+        max_correspondence_distance, point_to_plane,
+        max_iteration=30, relative_fitness=1e-6, relative_rmse=1e-6):
+    # Same as o3d.pipelines.registration.registration_icp(), but uses prepared target.
+    # Returns relative pose, fitness, rmse and number of iterations.
+    if point_to_plane and target.normals is None:
+        raise RuntimeError("Target has no normals for point to plane ICP.")
+
+    relative_pose = init_relative_pose.copy()
+    transformed = _transform_points(source_points, relative_pose)
+    source_indices, target_indices, distances = \
+        target.find_correspondences(transformed, max_correspondence_distance)
+    fitness, rmse = _get_fitness_and_rmse(distances, len(source_points))
+
+    iterations = 0
+    for iterations in range(1, max_iteration + 1):
+        if len(source_indices) < 3:
+            break
+        p = transformed[source_indices]
+        q = target.points[target_indices]
+        if point_to_plane:
+            update = _estimate_point_to_plane(p, q, target.normals[target_indices])
+        else:
+            update = _estimate_point_to_point(p, q)
+        relative_pose = np.matmul(update, relative_pose)
+
+        transformed = _transform_points(source_points, relative_pose)
+        source_indices, target_indices, distances = \
+            target.find_correspondences(transformed, max_correspondence_distance)
+        prev_fitness, prev_rmse = fitness, rmse
+        fitness, rmse = _get_fitness_and_rmse(distances, len(source_points))
+        if abs(prev_fitness - fitness) < relative_fitness and \
+                abs(prev_rmse - rmse) < relative_rmse:
+            break
+    return relative_pose, fitness, rmse, iterations
+
+
+def _get_fitness_and_rmse(distances, n):
+    if len(distances) == 0:
+        return 0., 0.
+    return len(distances) / n, np.sqrt(np.mean(distances ** 2))
+
+
+def _estimate_point_to_point(p, q):
+    # rigid transform minimizing |R * p + t - q|
+    p_mean = p.mean(axis=0)
+    q_mean = q.mean(axis=0)
+    H = np.matmul((p - p_mean).T, q - q_mean)
+    U, _, Vt = np.linalg.svd(H)
+    D = np.eye(3)
+    D[2, 2] = np.sign(np.linalg.det(np.matmul(Vt.T, U.T)))
+    R = np.matmul(np.matmul(Vt.T, D), U.T)
+    transformation = np.eye(4)
+    transformation[:3, :3] = R
+    transformation[:3, 3] = q_mean - np.matmul(R, p_mean)
+    return transformation
+
+
+def _estimate_point_to_plane(p, q, normals):
+    # linearized transform minimizing |dot(R * p + t - q, n)|
+    A = np.hstack((np.cross(p, normals), normals))
+    b = np.sum((q - p) * normals, axis=1)
+    # Directions not constrained by correspondences (e.g. sliding along a plane)
+    # give (nearly) zero singular values of A. They are cut off by rcond,
+    # so the minimum norm solution does not move along them. For fully degenerate
+    # correspondences this gives identity, as Open3D does.
+    x, _, _, _ = np.linalg.lstsq(A, b, rcond=1e-4)
+    transformation = np.eye(4)
+    transformation[:3, :3] = Rotation.from_euler('xyz', x[:3]).as_matrix()
+    transformation[:3, 3] = x[3:]
+    return transformation
+
+
+class RegistrationPyramid:
+    # Point cloud downsampled with every voxel size used by ICP stages.
+    # Coarse levels are downsampled from the finest one (normals are averaged,
+    # not estimated again), levels and their targets are built lazily and cached.
+
+    def __init__(self, pc: o3d.geometry.PointCloud, voxel_size, levels=None):
+        # pc: point cloud downsampled with voxel_size
+        # levels: dict with already downsampled coarse levels by voxel sizes
+        self.voxel_size = voxel_size
+        self._levels = dict(levels) if levels is not None else dict()
+        self._levels[voxel_size] = pc
+        self._targets = dict()
+
+    def get_level(self, voxel_size):
+        assert voxel_size >= self.voxel_size
+        if voxel_size not in self._levels:
+            level = self._levels[self.voxel_size].voxel_down_sample(voxel_size)
+            if level.has_normals():
+                level.normalize_normals()
+            self._levels[voxel_size] = level
+        return self._levels[voxel_size]
+
+    def get_points(self, voxel_size):
+        return np.asarray(self.get_level(voxel_size).points)
+
+    def get_target(self, voxel_size):
+        if voxel_size not in self._targets:
+            self._targets[voxel_size] = RegistrationTarget(self.get_level(voxel_size))
+        return self._targets[voxel_size]
+
+
+class RegistrationStage:
+    def __init__(self, max_correspondence_distance, time, iterations, fitness, rmse):
+        self.max_correspondence_distance = max_correspondence_distance
+        self.time = time
+        self.iterations = iterations
+        self.fitness = fitness
+        self.rmse = rmse
 
 
 class BaseOdometry:
     POINT_TO_POINT = 0
     POINT_TO_PLANE = 1
 
-    def __init__(self, voxel_size, max_correspondence_distances, icp_method):
+    def __init__(self, voxel_size, max_correspondence_distances, icp_method,
+            stages_voxel_sizes=None, stages_criteria=None,
+            constant_velocity=False, early_exit_fitness=None, early_exit_rmse=None):
+        # stages_voxel_sizes: voxel sizes of point clouds used by ICP stages,
+        #     coarse stages can run on more downsampled point clouds.
+        #     By default all stages use voxel_size.
+        # stages_criteria: o3d.pipelines.registration.ICPConvergenceCriteria
+        #     for every ICP stage or a single one for all stages.
+        # constant_velocity: if True, ICP is initialized with the last motion
+        #     when motion is not passed to compute().
+        # early_exit_fitness, early_exit_rmse: remaining ICP stages are skipped
+        #     when fitness and rmse of a stage reach these thresholds.
         assert icp_method in (
             BaseOdometry.POINT_TO_POINT,
             BaseOdometry.POINT_TO_PLANE)
+        if stages_voxel_sizes is None:
+            stages_voxel_sizes = [voxel_size] * len(max_correspondence_distances)
+        assert len(stages_voxel_sizes) == len(max_correspondence_distances)
+        assert all(stage_voxel_size >= voxel_size for stage_voxel_size in stages_voxel_sizes)
+        if stages_criteria is None:
+            stages_criteria = o3d.pipelines.registration.ICPConvergenceCriteria()
+        if isinstance(stages_criteria, o3d.pipelines.registration.ICPConvergenceCriteria):
+            stages_criteria = [stages_criteria] * len(max_correspondence_distances)
+        assert len(stages_criteria) == len(max_correspondence_distances)
 
         self.voxel_size = voxel_size
         self.max_correspondence_distances = max_correspondence_distances
         self.icp_method = icp_method
+        self.stages_voxel_sizes = stages_voxel_sizes
+        self.stages_criteria = stages_criteria
+        self.constant_velocity = constant_velocity
+        self.early_exit_fitness = early_exit_fitness
+        self.early_exit_rmse = early_exit_rmse
+
+        # statistics of ICP stages of the last registration
+        self.last_registration_stages = list()
+        self.last_registration_iterations = 0
+
+        self._last_motion = np.eye(4)
+
+    def _predict_motion(self, motion):
+        # motion: relative pose of the current frame in the previous frame or None
+        if motion is not None:
+            return motion
+        if self.constant_velocity:
+            return self._last_motion
+        return np.eye(4)
+
+    def _update_motion(self, prev_pose, pose):
+        self._last_motion = np.matmul(np.linalg.inv(prev_pose), pose)
 
     def _register(self, source, target, init_relative_pose):
-        if self.icp_method == BaseOdometry.POINT_TO_POINT:
-            estimation_method = \
-                o3d.pipelines.registration.TransformationEstimationPointToPoint()
-        elif self.icp_method == BaseOdometry.POINT_TO_PLANE:
-            estimation_method = \
-                o3d.pipelines.registration.TransformationEstimationPointToPlane()
+        # source, target: o3d.geometry.PointCloud downsampled with voxel_size
+        #     or RegistrationPyramid
+        if not isinstance(source, RegistrationPyramid):
+            source = RegistrationPyramid(source, self.voxel_size)
+        if not isinstance(target, RegistrationPyramid):
+            target = RegistrationPyramid(target, self.voxel_size)
+        point_to_plane = self.icp_method == BaseOdometry.POINT_TO_PLANE
 
+        self.last_registration_stages = list()
         relative_pose = init_relative_pose
-        for max_correspondence_distance in self.max_correspondence_distances:
-            reg = o3d.pipelines.registration.registration_icp(
-                source, target,
-                max_correspondence_distance, init=relative_pose,
-                estimation_method=estimation_method)
-            relative_pose = reg.transformation
-            if relative_pose is None:
-                raise RuntimeError("ICP failed.")
+        for max_correspondence_distance, stage_voxel_size, criteria in \
+                zip(self.max_correspondence_distances, self.stages_voxel_sizes,
+                    self.stages_criteria):
+            start_time = monotonic()
+            relative_pose, fitness, rmse, iterations = _register_icp(
+                source.get_points(stage_voxel_size), target.get_target(stage_voxel_size),
+                relative_pose, max_correspondence_distance, point_to_plane,
+                max_iteration=criteria.max_iteration,
+                relative_fitness=criteria.relative_fitness,
+                relative_rmse=criteria.relative_rmse)
+            self.last_registration_stages.append(RegistrationStage(
+                max_correspondence_distance, monotonic() - start_time,
+                iterations, fitness, rmse))
+            if self._is_converged(fitness, rmse):
+                break
+        self.last_registration_iterations = \
+            sum(stage.iterations for stage in self.last_registration_stages)
         return relative_pose
 
+    def _is_converged(self, fitness, rmse):
+        if self.early_exit_fitness is None and self.early_exit_rmse is None:
+            return False
+        if self.early_exit_fitness is not None and fitness < self.early_exit_fitness:
+            return False
+        if self.early_exit_rmse is not None and rmse > self.early_exit_rmse:
+            return False
+        return True
+
+    def _prepare_frame(self, pc):
+        down_pc = pc.voxel_down_sample(self.voxel_size)
+        if self.icp_method == BaseOdometry.POINT_TO_PLANE and \
+                not down_pc.has_normals():
+            self._estimate_normals(down_pc)
+        return down_pc, RegistrationPyramid(down_pc, self.voxel_size)
+
     def _estimate_normals(self, pc):
         assert not pc.has_normals()
         pc.estimate_normals(
             search_param=o3d.geometry.KDTreeSearchParamHybrid(
                 radius=self.voxel_size * 4, max_nn=30),
             fast_normal_computation=False)
+        # point cloud is in sensor frame, orient normals to the sensor
+        # so they can be averaged when downsampling
+        pc.orient_normals_towards_camera_location()
 
-    def compute(self, pc: o3d.geometry.PointCloud):
+    def compute(self, pc: o3d.geometry.PointCloud, motion=None):
+        # motion: relative pose of pc in the previous frame (e.g. from wheel odometry or IMU)
+        #     used as initial guess for ICP
+        return self._compute_prepared(self._prepare_frame(pc), motion)
+
+    def _compute_prepared(self, frame, motion):
+        # frame: result of _prepare_frame()
         raise NotImplementedError()
 
 
 class Odometry(BaseOdometry):
-    def __init__(self, voxel_size, max_correspondence_distances, icp_method):
-        super().__init__(voxel_size, max_correspondence_distances, icp_method)
+    def __init__(self, voxel_size, max_correspondence_distances, icp_method, **kwargs):
+        super().__init__(voxel_size, max_correspondence_distances, icp_method, **kwargs)
 
         self.last_pose = np.eye(4)
         self.last_frame = None
+        self._last_pyramid = None
 
-    def compute(self, pc: o3d.geometry.PointCloud):
+    def _compute_prepared(self, frame, motion):
+        down_pc, pyramid = frame
         if self.last_frame is None:
-            self.last_frame = pc.voxel_down_sample(self.voxel_size)
-            if self.icp_method == BaseOdometry.POINT_TO_PLANE and \
-                    not self.last_frame.has_normals():
-                self._estimate_normals(self.last_frame)
+            self.last_frame = down_pc
+            self._last_pyramid = pyramid
             return self.last_pose
 
-        down_pc = pc.voxel_down_sample(self.voxel_size)
-        relative_pose = self._register(down_pc, self.last_frame, np.eye(4))
+        relative_pose = self._register(pyramid, self._last_pyramid,
+            self._predict_motion(motion))
         pose = np.matmul(self.last_pose, relative_pose)
+        self._update_motion(self.last_pose, pose)
 
         self.last_pose = pose
         self.last_frame = down_pc
-        if self.icp_method == BaseOdometry.POINT_TO_PLANE and \
-                not self.last_frame.has_normals():
-            self._estimate_normals(self.last_frame)
+        self._last_pyramid = pyramid
         return self.last_pose
 
 
+class LocalMapOdometry(BaseOdometry):
+    # Registers frames against a local map built from the last window_size registered
+    # frames. The map is voxel hashed with map_voxel_size and keeps normals
+    # of inserted frames, so normals are estimated once per frame and never on the map.
+    # Coarser voxel sizes of ICP stages have their own voxel maps updated the same way,
+    # so the local map is never downsampled as a whole.
+    # map_voxel_size should not be larger than voxel_size of any ICP stage.
+
+    def __init__(self, voxel_size, max_correspondence_distances, icp_method,
+            window_size=20, map_voxel_size=None, **kwargs):
+        super().__init__(voxel_size, max_correspondence_distances, icp_method, **kwargs)
+        self.window_size = window_size
+        self.map_voxel_size = map_voxel_size if map_voxel_size is not None else voxel_size
+
+        self.last_pose = np.eye(4)
+        self.local_map = VoxelMap(self.map_voxel_size)
+        self._coarse_local_maps = {stage_voxel_size: VoxelMap(stage_voxel_size)
+            for stage_voxel_size in set(self.stages_voxel_sizes)
+            if stage_voxel_size > self.map_voxel_size}
+        self._local_map_pyramid = None
+        self._window = deque()  # registered frames in map frame
+
+    def _compute_prepared(self, frame, motion):
+        down_pc, pyramid = frame
+        if len(self._window) > 0:
+            predicted_pose = np.matmul(self.last_pose, self._predict_motion(motion))
+            pose = self._register(pyramid, self._local_map_pyramid, predicted_pose)
+            self._update_motion(self.last_pose, pose)
+        else:
+            pose = self.last_pose
+
+        self._insert(down_pc, pose)
+        self.last_pose = pose
+        return self.last_pose
+
+    def _insert(self, down_pc, pose):
+        frame = o3d.geometry.PointCloud(down_pc)
+        frame.transform(pose)
+        points = np.asarray(frame.points)
+        normals = np.asarray(frame.normals) if frame.has_normals() else None
+        local_maps = [self.local_map] + list(self._coarse_local_maps.values())
+        for local_map in local_maps:
+            local_map.insert(points, normals=normals)
+        self._window.append((points, normals))
+
+        if len(self._window) > self.window_size:
+            old_points, old_normals = self._window.popleft()
+            for local_map in local_maps:
+                local_map.remove(old_points, normals=old_normals)
+        self._local_map_pyramid = RegistrationPyramid(
+            self.local_map.to_point_cloud(), self.map_voxel_size,
+            levels={stage_voxel_size: local_map.to_point_cloud()
+                for stage_voxel_size, local_map in self._coarse_local_maps.items()})
+
+
 class ReferenceFrameOdometry(BaseOdometry):
     def __init__(self, voxel_size, max_correspondence_distances, icp_method,
-            fitness_threshold=0.8, store_reference_frames=False):
-        super().__init__(voxel_size, max_correspondence_distances, icp_method)
+            fitness_threshold=0.8, store_reference_frames=False, keyframe_store=None, **kwargs):
+        # keyframe_store: KeyframeStore to store reference frames on disk
+        #     instead of memory if store_reference_frames is True
+        assert keyframe_store is None or store_reference_frames
+        super().__init__(voxel_size, max_correspondence_distances, icp_method, **kwargs)
         self.fitness_threshold = fitness_threshold
         self.store_reference_frames = store_reference_frames
 
@@ -84,186 +683,455 @@ class ReferenceFrameOdometry(BaseOdometry):
 
         self.reference_pose = None
         self.reference_frame = None
+        self.reference_pyramid = None  # reused while reference frame is not changed
         self.reference_frame_changed = False
         self.reference_frames_counter = 0
 
         if self.store_reference_frames:
             self.reference_poses = list()
-            self.reference_frames = list()
+            self.reference_frames = keyframe_store if keyframe_store is not None else list()
         else:
             self.reference_poses = None
             self.reference_frames = None
 
-    def compute(self, pc: o3d.geometry.PointCloud):
+    def compute(self, pc: o3d.geometry.PointCloud, motion=None):
+        # Normals are estimated only for frames that become reference frames.
+        # AsyncOdometry uses _prepare_frame() and estimates normals of all frames
+        # in its preparation thread instead.
+        down_pc = pc.voxel_down_sample(self.voxel_size)
+        return self._compute_prepared(
+            (down_pc, RegistrationPyramid(down_pc, self.voxel_size)), motion)
+
+    def _compute_prepared(self, frame, motion):
+        down_pc, pyramid = frame
         if self.reference_frame is None:
-            self.reference_pose = self.last_pose
-            self.reference_frame = pc.voxel_down_sample(self.voxel_size)
-            if self.icp_method == BaseOdometry.POINT_TO_PLANE and \
-                    not self.reference_frame.has_normals():
-                self._estimate_normals(self.reference_frame)
-            self.reference_frame_changed = True
-            self.reference_frames_counter += 1
-
-            if self.store_reference_frames:
-                self.reference_poses.append(self.reference_pose)
-                self.reference_frames.append(self.reference_frame)
+            self._set_reference_frame(self.last_pose, down_pc, pyramid)
             return self.last_pose
 
-        down_pc = pc.voxel_down_sample(self.voxel_size)
-        relative_pose = np.matmul(np.linalg.inv(self.reference_pose), self.last_pose)
-        relative_pose = self._register(down_pc, self.reference_frame, relative_pose)
+        predicted_pose = np.matmul(self.last_pose, self._predict_motion(motion))
+        relative_pose = np.matmul(np.linalg.inv(self.reference_pose), predicted_pose)
+        relative_pose = self._register(pyramid, self.reference_pyramid, relative_pose)
         pose = np.matmul(self.reference_pose, relative_pose)
+        self._update_motion(self.last_pose, pose)
 
-        results = o3d.pipelines.registration.evaluate_registration(
-            down_pc, self.reference_frame,
-            self.voxel_size * 1.5, transformation=relative_pose)
-        if results.fitness < self.fitness_threshold:
-            self.reference_pose = pose.copy()  # copy() is needed because
-                                               # "pose" is returned from this function
-            self.reference_frame = down_pc
-            if self.icp_method == BaseOdometry.POINT_TO_PLANE and \
-                    not self.reference_frame.has_normals():
-                self._estimate_normals(self.reference_frame)
-            self.reference_frame_changed = True
-            self.reference_frames_counter += 1
-
-            if self.store_reference_frames:
-                self.reference_poses.append(self.reference_pose)
-                self.reference_frames.append(self.reference_frame)
+        fitness, _ = self.reference_pyramid.get_target(self.voxel_size).evaluate(
+            np.asarray(down_pc.points), self.voxel_size * 1.5, relative_pose)
+        if fitness < self.fitness_threshold:
+            # copy() is needed because "pose" is returned from this function
+            self._set_reference_frame(pose.copy(), down_pc, pyramid)
         else:
             self.reference_frame_changed = False
 
         self.last_pose = pose
         return self.last_pose
-    
+
+    def _set_reference_frame(self, pose, down_pc, pyramid):
+        self.reference_pose = pose
+        self.reference_frame = down_pc
+        if self.icp_method == BaseOdometry.POINT_TO_PLANE and \
+                not self.reference_frame.has_normals():
+            self._estimate_normals(self.reference_frame)
+            # coarse levels are built from the frame with normals
+            pyramid = RegistrationPyramid(self.reference_frame, self.voxel_size)
+        self.reference_pyramid = pyramid
+        self.reference_frame_changed = True
+        self.reference_frames_counter += 1
+
+        if self.store_reference_frames:
+            self.reference_poses.append(self.reference_pose)
+            self.reference_frames.append(self.reference_frame)
+
+
+class _AsyncOdometryWorker:
+    # State and threads of AsyncOdometry. Threads reference only the worker,
+    # so AsyncOdometry can be garbage collected and close the worker.
+
+    def __init__(self, odometry: BaseOdometry, name):
+        self.odometry = odometry
+
+        self.frames_processed = 0
+        self.preparation_time = TimeMeasurer(f"{name}_preparation")
+        self.registration_time = TimeMeasurer(f"{name}_registration")
+        self.latency = TimeMeasurer(f"{name}_latency")  # from put() to pose ready
+
+        self.input = deque()  # [pc, motion, stamp, put stamp, put time]
+        self.input_condition = threading.Condition()
+        self.results = queue.Queue()
+        self.start_time = None
+        self.stop_time = None
+        self.error = None
+        self.closed = False
+
+        self._prepared = queue.Queue(maxsize=1)
+        self._preparation_thread = threading.Thread(target=self._run_preparation, daemon=True)
+        self._registration_thread = threading.Thread(target=self._run_registration, daemon=True)
+        self._preparation_thread.start()
+        self._registration_thread.start()
+
+    def close(self):
+        # waits until all enqueued frames are processed
+        with self.input_condition:
+            self.closed = True
+            self.input_condition.notify_all()
+        self._preparation_thread.join()
+        self._registration_thread.join()
+
+    def _run_preparation(self):
+        while self.error is None:
+            with self.input_condition:
+                while len(self.input) == 0 and not self.closed:
+                    self.input_condition.wait()
+                if len(self.input) == 0:
+                    break
+                frame = self.input.popleft()
+                self.input_condition.notify_all()
+            try:
+                with self.preparation_time:
+                    prepared_frame = self.odometry._prepare_frame(frame[0])
+            except Exception as e:
+                self._set_error(e)
+                break
+            self._prepared.put((prepared_frame, frame))
+        self._prepared.put(None)
+
+    def _run_registration(self):
+        while True:
+            item = self._prepared.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            prepared_frame, (_, motion, stamp, put_stamp, put_time) = item
+            try:
+                with self.registration_time:
+                    pose = self.odometry._compute_prepared(prepared_frame, motion).copy()
+            except Exception as e:
+                self._set_error(e)
+                continue
+            self.stop_time = monotonic()
+            self.latency.add((put_stamp, self.stop_time - put_time))
+            self.frames_processed += 1
+            self.results.put((stamp, pose))
+        self.results.put(None)
+
+    def _set_error(self, e):
+        with self.input_condition:
+            self.error = f"{type(e).__name__}: {e}"
+            self.input_condition.notify_all()
+
+
+class AsyncOdometry:
+    # Pipelines odometry in two background threads: preparation of the next frame
+    # (downsampling, normal estimation) runs while ICP of the current frame runs.
+    # put() enqueues frames into a bounded input queue. When the queue is full,
+    # the oldest waiting frame is dropped (DROP_OLDEST) or put() blocks (BLOCK).
+    # Poses are returned by get() in order of frames.
+    # Threads are stopped by close(), on exit from with block,
+    # when the pipeline is garbage collected or at interpreter exit.
+
+    DROP_OLDEST = 0
+    BLOCK = 1
+
+    def __init__(self, odometry: BaseOdometry, queue_size=4, drop_policy=DROP_OLDEST,
+            name="odometry"):
+        assert drop_policy in (
+            AsyncOdometry.DROP_OLDEST,
+            AsyncOdometry.BLOCK)
+        assert queue_size > 0
+
+        self.odometry = odometry
+        self.queue_size = queue_size
+        self.drop_policy = drop_policy
+
+        self.frames_dropped = 0
+
+        self._worker = _AsyncOdometryWorker(odometry, name)
+        self.preparation_time = self._worker.preparation_time
+        self.registration_time = self._worker.registration_time
+        self.latency = self._worker.latency
+        self._finished = False
+        self._finalizer = weakref.finalize(self, self._worker.close)
+
+    @property
+    def frames_processed(self):
+        return self._worker.frames_processed
+
+    def put(self, pc: o3d.geometry.PointCloud, motion=None, stamp=None):
+        # motion: relative pose of pc in the previously put frame, see BaseOdometry.compute().
+        #     If frames are dropped, motions are accumulated.
+        # stamp: returned by get() with the pose, time of put() by default
+        worker = self._worker
+        if worker.closed:
+            raise RuntimeError("Odometry pipeline is closed")
+        self._check_error()
+
+        put_stamp = time()
+        frame = [pc, motion, stamp if stamp is not None else put_stamp, put_stamp, monotonic()]
+        with worker.input_condition:
+            if worker.start_time is None:
+                worker.start_time = frame[4]
+            if self.drop_policy == AsyncOdometry.BLOCK:
+                while len(worker.input) >= self.queue_size and worker.error is None:
+                    worker.input_condition.wait()
+                self._check_error()
+            else:
+                while len(worker.input) >= self.queue_size:
+                    self._drop_oldest(frame)
+            worker.input.append(frame)
+            worker.input_condition.notify_all()
+
+    def get(self, block=True, timeout=None):
+        # returns (stamp, pose) or None when the pipeline is closed and all poses are returned.
+        # Raises queue.Empty if block is False or timeout expired.
+        if self._finished:
+            return None
+        result = self._worker.results.get(block=block, timeout=timeout)
+        if result is None:
+            self._finished = True
+            self._check_error()
+        return result
+
+    def get_throughput(self):
+        # processed frames per second
+        worker = self._worker
+        if worker.stop_time is None or worker.stop_time <= worker.start_time:
+            return 0.
+        return worker.frames_processed / (worker.stop_time - worker.start_time)
+
+    def close(self):
+        # waits until all enqueued frames are processed
+        if not self._finalizer.alive:
+            return
+        self._finalizer()
+        self._check_error()
+
+    def _drop_oldest(self, new_frame):
+        dropped_frame = self._worker.input.popleft()
+        self.frames_dropped += 1
+        # motion of the next frame becomes relative to the frame before the dropped one
+        next_frame = self._worker.input[0] if len(self._worker.input) > 0 else new_frame
+        if dropped_frame[1] is not None and next_frame[1] is not None:
+            next_frame[1] = np.matmul(dropped_frame[1], next_frame[1])
+        else:
+            next_frame[1] = None
+
+    def _check_error(self):
+        if self._worker.error is not None:
+            raise RuntimeError(self._worker.error)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
 
 class PoseGraph:
     POINT_TO_POINT = 0
     POINT_TO_PLANE = 1
 
+    DESCRIPTOR_QUANTILES = np.linspace(0.05, 0.95, 19)
+
     def __init__(self, reference_poses, reference_frames,
             max_correspondence_distances, voxel_size, refine_icp_method,
             fitness_threshold=0.6,
-            max_position_correction_rate=0.05, max_orientation_correction_rate=0.03):
+            max_position_correction_rate=0.05, max_orientation_correction_rate=0.03,
+            loop_search_radius=None, descriptor_threshold=None, num_workers=1,
+            keyframe_store=None, targets_cache_size=None):
+        # loop_search_radius: only frames closer than
+        #     loop_search_radius + max_position_correction_rate * traveled distance
+        #     are registered to find loops. If None, all pairs of frames are registered.
+        # descriptor_threshold: if not None, frames with range descriptors
+        #     (see _get_descriptor()) differing by more than descriptor_threshold meters
+        #     are not registered.
+        # num_workers: number of threads registering loop candidates
+        # keyframe_store: KeyframeStore to keep frames on disk, frames are appended to it.
+        #     It can be the same store that is passed as reference_frames
+        #     (e.g. ReferenceFrameOdometry.reference_frames), then frames are not copied.
+        # targets_cache_size: number of frames prepared for registration kept in memory,
+        #     cache_size of keyframe_store if it is given, all otherwise
+        #
+        # Pose graph can be built online: pass empty reference_poses and reference_frames
+        # and call add_keyframe() when ReferenceFrameOdometry changes reference frame.
         assert len(reference_poses) == len(reference_frames)
-        assert len(reference_poses) >= 3
         assert refine_icp_method in (
             PoseGraph.POINT_TO_POINT,
             PoseGraph.POINT_TO_PLANE)
 
-        self.reference_poses = reference_poses
-        self.reference_frames = reference_frames
+        self.reference_poses = list()
+        self.reference_frames = keyframe_store if keyframe_store is not None else list()
         self.max_correspondence_distances = max_correspondence_distances
         self.voxel_size = voxel_size
         self.refine_icp_method = refine_icp_method
         self.fitness_threshold = fitness_threshold
         self.max_position_correction_rate = max_position_correction_rate
         self.max_orientation_correction_rate = max_orientation_correction_rate
+        self.loop_search_radius = loop_search_radius
+        self.descriptor_threshold = descriptor_threshold
+        self.num_workers = num_workers
+        if targets_cache_size is None and keyframe_store is not None:
+            targets_cache_size = keyframe_store.cache_size
+        self.targets_cache_size = targets_cache_size
 
         self.pose_graph = o3d.pipelines.registration.PoseGraph()
-        self._fill_pose_graph()
-
         self.accum_distances = list()
         self.accum_angles = list()
-        self._fill_accum()
 
         self._loops = set()
+        self._targets = OrderedDict()
+        self._targets_mutex = threading.Lock()
+        self._descriptors = dict()
+        self._num_checked_nodes = 0  # pairs with both nodes below were checked for loops
+        self._affected_node = None  # first node of loops added after the last optimization
+        self._mutex = threading.Lock()  # guards nodes and edges of pose_graph
+        self._optimization_thread = None
+        self._optimization_error = None
 
-    def _fill_pose_graph(self):
-        for pose in self.reference_poses:
-            self.pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(pose))
+        frames_are_stored = reference_frames is self.reference_frames
+        for i, pose in enumerate(reference_poses):
+            self.add_keyframe(pose, None if frames_are_stored else reference_frames[i])
 
-        for i, (prev_pose, prev_frame, pose, frame) in \
-                enumerate(zip(
-                    self.reference_poses[:-1], self.reference_frames[:-1],
-                    self.reference_poses[1:], self.reference_frames[1:])):
-            relative_pose_inv = np.matmul(np.linalg.inv(pose), prev_pose)
-            information = o3d.pipelines.registration.get_information_matrix_from_point_clouds(
-                prev_frame, frame, self.voxel_size * 1.5, relative_pose_inv)
-            self.pose_graph.edges.append(o3d.pipelines.registration.PoseGraphEdge(
-                i,
-                i + 1,
-                relative_pose_inv,
-                information,
-                uncertain=False))
-            
-    def _fill_accum(self):
-        accum_distance = 0
-        accum_angle = 0
-        self.accum_distances.append(accum_distance)
-        self.accum_angles.append(accum_angle)
-        for prev_pose, pose in zip(self.reference_poses[:-1], self.reference_poses[1:]):
+    def add_keyframe(self, pose, frame=None):
+        # pose: pose of the frame estimated by odometry
+        # frame: None if the frame is already appended to keyframe_store
+        # returns index of the new node
+        i = len(self.reference_poses)
+        if frame is None:
+            assert len(self.reference_frames) > i
+            frame = self.reference_frames[i]
+        else:
+            assert len(self.reference_frames) == i
+        if i > 0:
+            prev_pose = self.reference_poses[-1]
             relative_pose = np.matmul(np.linalg.inv(prev_pose), pose)
-            translation = relative_pose[:3, 3]
-            rotation = relative_pose[:3, :3]
-            distance = np.linalg.norm(translation)
-            angle = np.linalg.norm(Rotation.from_matrix(rotation).as_rotvec())
+            relative_pose_inv = np.linalg.inv(relative_pose)
+            information = o3d.pipelines.registration.get_information_matrix_from_point_clouds(
+                self.reference_frames[i - 1], frame, self.voxel_size * 1.5, relative_pose_inv)
+
+            distance = np.linalg.norm(relative_pose[:3, 3])
+            angle = np.linalg.norm(Rotation.from_matrix(relative_pose[:3, :3]).as_rotvec())
+            accum_distance = self.accum_distances[-1] + distance
+            accum_angle = self.accum_angles[-1] + angle
+        else:
+            accum_distance = 0
+            accum_angle = 0
 
-            accum_distance += distance
-            accum_angle += angle
+        if len(self.reference_frames) == i:
+            self.reference_frames.append(frame)
+        with self._mutex:
+            if i > 0:
+                # new node follows correction of the previous node
+                prev_node_pose = self.pose_graph.nodes[i - 1].pose
+                node_pose = np.matmul(prev_node_pose, relative_pose)
+            else:
+                node_pose = pose
+            self.reference_poses.append(pose)
             self.accum_distances.append(accum_distance)
             self.accum_angles.append(accum_angle)
+            self.pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(node_pose))
+            if i > 0:
+                self.pose_graph.edges.append(o3d.pipelines.registration.PoseGraphEdge(
+                    i - 1,
+                    i,
+                    relative_pose_inv,
+                    information,
+                    uncertain=False))
+        return i
 
-    def _register(self, source, target, init_relative_pose):
-        if self.refine_icp_method == PoseGraph.POINT_TO_POINT:
-            estimation_method = \
-                o3d.pipelines.registration.TransformationEstimationPointToPoint()
-        elif self.refine_icp_method == PoseGraph.POINT_TO_PLANE:
-            estimation_method = \
-                o3d.pipelines.registration.TransformationEstimationPointToPlane()
-
-        relative_pose = init_relative_pose
-        for max_correspondence_distance in self.max_correspondence_distances:
-            reg = o3d.pipelines.registration.registration_icp(
-                source, target,
-                max_correspondence_distance, init=relative_pose,
-                estimation_method=estimation_method)
-            relative_pose = reg.transformation
-            if relative_pose is None:
-                raise RuntimeError("ICP failed.")
-        return relative_pose
-
-    def compute_loops(self):
-        for i, (node_i, frame_i) in \
-                enumerate(zip(self.pose_graph.nodes, self.reference_frames)):
+    def _get_target(self, i):
+        # targets are built once and reused by all registrations against the frame
+        with self._targets_mutex:
+            if i in self._targets:
+                self._targets.move_to_end(i)
+                return self._targets[i]
+        target = RegistrationTarget(self.reference_frames[i])
+        with self._targets_mutex:
+            self._targets[i] = target
+            if self.targets_cache_size is not None:
+                while len(self._targets) > self.targets_cache_size:
+                    self._targets.popitem(last=False)
+        return target
 
-            for j, (node_j, frame_j) in \
-                    enumerate(zip(self.pose_graph.nodes[i + 2:], self.reference_frames[i + 2:]),
-                        start=(i + 2)):
+    def _get_descriptor(self, i):
+        # quantiles of distances from the sensor to points of the frame,
+        # cheap rotation invariant signature of the place
+        if i not in self._descriptors:
+            ranges = np.linalg.norm(np.asarray(self.reference_frames[i].points), axis=1)
+            self._descriptors[i] = np.quantile(ranges, PoseGraph.DESCRIPTOR_QUANTILES) \
+                if len(ranges) > 0 else None
+        return self._descriptors[i]
 
-                if (i, j) in self._loops:
-                    continue
+    def _get_loop_candidates(self, n, min_j=0):
+        # returns sorted pairs (i, j), min_j <= j < n, j >= i + 2, that can be loops
+        if n < 3:
+            return list()
+        if self.loop_search_radius is None:
+            candidates = [(i, j) for i in range(n) for j in range(max(i + 2, min_j), n)]
+        else:
+            with self._mutex:
+                positions = np.array([node.pose[:3, 3] for node in self.pose_graph.nodes[:n]])
+            accum_distances = np.array(self.accum_distances[:n])
+            max_radius = self.loop_search_radius + \
+                self.max_position_correction_rate * (accum_distances[-1] - accum_distances[0])
+            pairs = cKDTree(positions).query_pairs(max_radius, output_type='ndarray')
+            pairs = pairs[(pairs[:, 1] >= pairs[:, 0] + 2) & (pairs[:, 1] >= min_j)]
+            distances = np.linalg.norm(positions[pairs[:, 0]] - positions[pairs[:, 1]], axis=1)
+            radii = self.loop_search_radius + self.max_position_correction_rate * \
+                (accum_distances[pairs[:, 1]] - accum_distances[pairs[:, 0]])
+            pairs = pairs[distances <= radii]
+            candidates = sorted(map(tuple, pairs.tolist()))
 
-                pose_i = node_i.pose
-                pose_j = node_j.pose
-                relative_pose_inv = np.matmul(np.linalg.inv(pose_j), pose_i)
-                relative_pose_inv_corrected = self._register(
-                    frame_i, frame_j, relative_pose_inv)
+        candidates = [(i, j) for i, j in candidates if (i, j) not in self._loops]
+        if self.descriptor_threshold is not None:
+            candidates = [(i, j) for i, j in candidates if self._match_descriptors(i, j)]
+        return candidates
 
-                results = o3d.pipelines.registration.evaluate_registration(
-                    frame_i, frame_j, self.voxel_size * 1.5,
-                    transformation=relative_pose_inv_corrected)
-                if results.fitness < self.fitness_threshold:
-                    continue
+    def _match_descriptors(self, i, j):
+        descriptor_i = self._get_descriptor(i)
+        descriptor_j = self._get_descriptor(j)
+        if descriptor_i is None or descriptor_j is None:
+            return False
+        difference = np.mean(np.abs(descriptor_i - descriptor_j))
+        return difference <= self.descriptor_threshold
 
-                correction = np.matmul(
-                    np.linalg.inv(relative_pose_inv), relative_pose_inv_corrected)
-                correction_translation = correction[:3, 3]
-                correction_rotation = correction[:3, :3]
-                position_correction = np.linalg.norm(correction_translation)
-                orientation_correction = np.linalg.norm(Rotation.from_matrix(correction_rotation).as_rotvec())
+    def _register(self, source, target, init_relative_pose):
+        source_points = np.asarray(source.points)
+        point_to_plane = self.refine_icp_method == PoseGraph.POINT_TO_PLANE
 
-                distance = self.accum_distances[j] - self.accum_distances[i]
-                angle = self.accum_angles[j] - self.accum_angles[i]
+        relative_pose = init_relative_pose
+        for max_correspondence_distance in self.max_correspondence_distances:
+            relative_pose, _, _, _ = _register_icp(
+                source_points, target, relative_pose,
+                max_correspondence_distance, point_to_plane)
+        return relative_pose
 
-                position_correction_rate = position_correction / distance
-                orientation_correction_rate = orientation_correction / angle
-                if position_correction_rate > self.max_position_correction_rate or \
-                        orientation_correction_rate > self.max_orientation_correction_rate:
-                    continue
+    def compute_loops(self, new_nodes_only=False):
+        # new_nodes_only: only pairs with nodes added after the previous call are checked
+        n = len(self.pose_graph.nodes)
+        candidates = self._get_loop_candidates(n,
+            min_j=(self._num_checked_nodes if new_nodes_only else 0))
+        self._num_checked_nodes = n
+        # pairs are registered grouped by target, so targets and frames
+        # are reused while they are cached
+        by_target = sorted(candidates, key=lambda pair: (pair[1], pair[0]))
+        if self.num_workers > 1:
+            if self.targets_cache_size is None:
+                # build shared targets before registrations run concurrently
+                for j in sorted(set(j for _, j in candidates)):
+                    self._get_target(j)
+            with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+                loops = list(executor.map(lambda pair: self._check_loop(*pair), by_target))
+        else:
+            loops = [self._check_loop(i, j) for i, j in by_target]
+        loops = dict(zip(by_target, loops))
 
-                information = o3d.pipelines.registration.get_information_matrix_from_point_clouds(
-                    frame_i, frame_j, self.voxel_size * 1.5, relative_pose_inv_corrected)
+        # edges are added in order of candidates regardless of num_workers
+        for i, j in candidates:
+            loop = loops[(i, j)]
+            if loop is None:
+                continue
+            relative_pose_inv_corrected, information = loop
+            with self._mutex:
                 self.pose_graph.edges.append(o3d.pipelines.registration.PoseGraphEdge(
                     i,
                     j,
@@ -271,10 +1139,201 @@ class PoseGraph:
                     information,
                     uncertain=True))
                 self._loops.add((i, j))
+                if self._affected_node is None or i < self._affected_node:
+                    self._affected_node = i
+
+    def _check_loop(self, i, j):
+        # returns relative pose and information matrix of the loop or None
+        frame_i = self.reference_frames[i]
+        frame_j = self.reference_frames[j]
+        with self._mutex:
+            pose_i = self.pose_graph.nodes[i].pose
+            pose_j = self.pose_graph.nodes[j].pose
+        relative_pose_inv = np.matmul(np.linalg.inv(pose_j), pose_i)
+        target_j = self._get_target(j)
+        relative_pose_inv_corrected = self._register(
+            frame_i, target_j, relative_pose_inv)
+
+        fitness, _ = target_j.evaluate(
+            np.asarray(frame_i.points), self.voxel_size * 1.5,
+            relative_pose_inv_corrected)
+        if fitness < self.fitness_threshold:
+            return None
+
+        correction = np.matmul(
+            np.linalg.inv(relative_pose_inv), relative_pose_inv_corrected)
+        correction_translation = correction[:3, 3]
+        correction_rotation = correction[:3, :3]
+        position_correction = np.linalg.norm(correction_translation)
+        orientation_correction = np.linalg.norm(Rotation.from_matrix(correction_rotation).as_rotvec())
+
+        distance = self.accum_distances[j] - self.accum_distances[i]
+        angle = self.accum_angles[j] - self.accum_angles[i]
+
+        position_correction_rate = position_correction / distance
+        orientation_correction_rate = orientation_correction / angle
+        if position_correction_rate > self.max_position_correction_rate or \
+                orientation_correction_rate > self.max_orientation_correction_rate:
+            return None
+
+        information = o3d.pipelines.registration.get_information_matrix_from_point_clouds(
+            frame_i, frame_j, self.voxel_size * 1.5, relative_pose_inv_corrected)
+        return relative_pose_inv_corrected, information
+
+    def save(self, folder):
+        # Saves pose graph to pose_graph.npz and frames to keyframes folder
+        # in KeyframeStore format. Pose graph saved in the folder before is overwritten.
+        self.wait_optimization()
+        os.makedirs(folder, exist_ok=True)
+        keyframes_folder = osp.join(folder, "keyframes")
+        if not isinstance(self.reference_frames, KeyframeStore) or \
+                osp.realpath(self.reference_frames.folder) != osp.realpath(keyframes_folder):
+            # frames are written to a temporary folder first, so keyframes saved
+            # before are replaced only after all frames are written
+            tmp_keyframes_folder = tempfile.mkdtemp(prefix="keyframes_", dir=folder)
+            try:
+                store = KeyframeStore(tmp_keyframes_folder, cache_size=0)
+                for frame in self.reference_frames:
+                    store.append(frame)
+            except BaseException:
+                shutil.rmtree(tmp_keyframes_folder)
+                raise
+            if osp.isdir(keyframes_folder):
+                shutil.rmtree(keyframes_folder)
+            os.replace(tmp_keyframes_folder, keyframes_folder)
+
+        with self._mutex:
+            edges = self.pose_graph.edges
+            np.savez(osp.join(folder, "pose_graph.npz"),
+                reference_poses=np.array(self.reference_poses).reshape(-1, 4, 4),
+                nodes_poses=np.array([node.pose for node in self.pose_graph.nodes]).reshape(-1, 4, 4),
+                edges_nodes=np.array([(edge.source_node_id, edge.target_node_id)
+                    for edge in edges], dtype=np.int64).reshape(-1, 2),
+                edges_transformations=np.array([edge.transformation for edge in edges]).reshape(-1, 4, 4),
+                edges_informations=np.array([edge.information for edge in edges]).reshape(-1, 6, 6),
+                edges_uncertain=np.array([edge.uncertain for edge in edges], dtype=bool),
+                edges_confidences=np.array([edge.confidence for edge in edges]),
+                loops=np.array(sorted(self._loops), dtype=np.int64).reshape(-1, 2),
+                accum_distances=np.array(self.accum_distances),
+                accum_angles=np.array(self.accum_angles),
+                num_checked_nodes=self._num_checked_nodes)
+
+    @classmethod
+    def load(cls, folder, max_correspondence_distances, voxel_size, refine_icp_method,
+            load_loops=True, cache_size=16, **kwargs):
+        # Loads pose graph saved by save(). Frames are loaded lazily from keyframes folder.
+        # Information matrices are not recomputed, so parameters can be changed and
+        # compute_loops() and optimize() rerun quickly.
+        # load_loops: if False, loop edges are dropped and nodes are reset to odometry poses
+        # kwargs: other parameters of PoseGraph
+        data = np.load(osp.join(folder, "pose_graph.npz"))
+        store = KeyframeStore(osp.join(folder, "keyframes"), cache_size=cache_size, load=True)
+        if len(store) != len(data["reference_poses"]):
+            raise RuntimeError(f"Number of keyframes in {folder} does not match pose graph")
+
+        obj = cls(list(), list(), max_correspondence_distances, voxel_size, refine_icp_method,
+            keyframe_store=store, **kwargs)
+        obj.reference_poses = list(data["reference_poses"])
+        obj.accum_distances = data["accum_distances"].tolist()
+        obj.accum_angles = data["accum_angles"].tolist()
+
+        nodes_poses = data["nodes_poses"] if load_loops else data["reference_poses"]
+        for pose in nodes_poses:
+            obj.pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(pose))
+        for (i, j), transformation, information, uncertain, confidence in zip(
+                data["edges_nodes"], data["edges_transformations"],
+                data["edges_informations"], data["edges_uncertain"], data["edges_confidences"]):
+            if uncertain and not load_loops:
+                continue
+            obj.pose_graph.edges.append(o3d.pipelines.registration.PoseGraphEdge(
+                int(i),
+                int(j),
+                transformation,
+                information,
+                uncertain=bool(uncertain),
+                confidence=float(confidence)))
+        if load_loops:
+            obj._loops = set(map(tuple, data["loops"].tolist()))
+            obj._num_checked_nodes = int(data["num_checked_nodes"])
+        return obj
+
+    def update_map(self, map_builder: MapBuilder):
+        # inserts new frames into the map and reinserts frames with corrected poses.
+        # Only these frames are loaded.
+        with self._mutex:
+            poses = [node.pose for node in self.pose_graph.nodes]
+        outdated = [i for i, pose in enumerate(poses) if map_builder.is_outdated(i, pose)]
+        reinserted = sum(i in map_builder for i in outdated)
+        if reinserted > len(map_builder) / 2:
+            # building from scratch is cheaper than removing most of the frames
+            map_builder.clear()
+            outdated = range(len(poses))
+        for i in outdated:
+            map_builder.update(i, self.reference_frames[i], poses[i])
+
+    def optimize(self, window_size=None):
+        # window_size: if not None, only the last window_size nodes and nodes back to
+        #     the first node of loops added after the previous optimization are optimized.
+        #     Optimization starts from current node poses.
+        self.wait_optimization()
+        self._optimize(window_size)
+
+    def optimize_async(self, window_size=None):
+        # Same as optimize() but runs in a background thread.
+        # Keyframes and loops can be added while optimization runs.
+        # Returns False if the previous optimization has not finished yet.
+        if self._optimization_thread is not None and self._optimization_thread.is_alive():
+            return False
+        self.wait_optimization()
+        self._optimization_thread = threading.Thread(
+            target=self._run_optimization, args=(window_size,), daemon=True)
+        self._optimization_thread.start()
+        return True
+
+    def wait_optimization(self):
+        if self._optimization_thread is not None:
+            self._optimization_thread.join()
+            self._optimization_thread = None
+        if self._optimization_error is not None:
+            error = self._optimization_error
+            self._optimization_error = None
+            raise RuntimeError(error)
+
+    def _run_optimization(self, window_size):
+        try:
+            self._optimize(window_size)
+        except Exception as e:
+            self._optimization_error = f"{type(e).__name__}: {e}"
+
+    def _optimize(self, window_size):
+        # optimizes a copy of the window, so pose graph can be extended meanwhile
+        with self._mutex:
+            n = len(self.pose_graph.nodes)
+            start = 0 if window_size is None else max(n - window_size, 0)
+            if self._affected_node is not None:
+                start = min(start, self._affected_node)
+            self._affected_node = None
+            if n - start < 2:
+                return
+
+            window = o3d.pipelines.registration.PoseGraph()
+            for node in self.pose_graph.nodes[start:n]:
+                window.nodes.append(o3d.pipelines.registration.PoseGraphNode(node.pose))
+            window_edges_indices = list()
+            for k, edge in enumerate(self.pose_graph.edges):
+                if edge.source_node_id < start or edge.target_node_id < start:
+                    continue
+                window.edges.append(o3d.pipelines.registration.PoseGraphEdge(
+                    edge.source_node_id - start,
+                    edge.target_node_id - start,
+                    edge.transformation,
+                    edge.information,
+                    uncertain=edge.uncertain))
+                window_edges_indices.append(k)
+            last_pose = self.pose_graph.nodes[n - 1].pose
 
-    def optimize(self):
         o3d.pipelines.registration.global_optimization(
-            self.pose_graph,
+            window,
             o3d.pipelines.registration.GlobalOptimizationLevenbergMarquardt(),
             o3d.pipelines.registration.GlobalOptimizationConvergenceCriteria(),
             o3d.pipelines.registration.GlobalOptimizationOption(
@@ -282,78 +1341,122 @@ class PoseGraph:
                 edge_prune_threshold=0.25,
                 reference_node=0))
 
+        with self._mutex:
+            for k, node in enumerate(window.nodes):
+                self.pose_graph.nodes[start + k].pose = node.pose
+            # nodes added during optimization follow correction of the last optimized node
+            correction = np.matmul(window.nodes[-1].pose, np.linalg.inv(last_pose))
+            for k in range(n, len(self.pose_graph.nodes)):
+                node = self.pose_graph.nodes[k]
+                node.pose = np.matmul(correction, node.pose)
+
+            # remove edges pruned by optimization
+            kept_edges = set((edge.source_node_id + start, edge.target_node_id + start)
+                for edge in window.edges)
+            for k in reversed(window_edges_indices):
+                edge = self.pose_graph.edges[k]
+                if (edge.source_node_id, edge.target_node_id) not in kept_edges:
+                    del self.pose_graph.edges[k]
+
     @staticmethod
-    def _lineset_to_cylinders(lineset):
-        cylinders = list()
-        points = np.asarray(lineset.points)
-        for line, color in zip(np.asarray(lineset.lines), np.asarray(lineset.colors)):
-            p1 = points[line[0]]
-            p2 = points[line[1]]
-            length = np.linalg.norm(p2 - p1)
-            if length < 0.001:
-                continue
+    def _lines_to_cylinders(starts, ends, colors, radius):
+        # builds one mesh with cylinders for all lines
+        directions = ends - starts
+        lengths = np.linalg.norm(directions, axis=1)
+        keep = lengths >= 0.001
+        starts, ends, colors = starts[keep], ends[keep], colors[keep]
+        directions, lengths = directions[keep], lengths[keep]
+
+        z = directions / lengths[:, np.newaxis]
 
-            z = (p2 - p1) / length
-
-            min_index = np.argmin(np.abs(z))
-            other_indices = np.delete(np.array([0, 1, 2]), min_index)
-            x = np.zeros((3,))
-            x[other_indices] = z[other_indices[::-1]] / np.linalg.norm(z[other_indices])
-            x[other_indices[0]] *= -1
-
-            y = np.cross(z, x)
-
-            center = (p1 + p2) / 2
-
-            transform = np.eye(4)
-            transform[:3, :3] = np.stack((x, y, z), axis=1)
-            transform[:3, 3] = center
-
-            cylinder = o3d.geometry.TriangleMesh.create_cylinder(
-                radius=0.001, height=length)
-            cylinder.transform(transform)
-            cylinder.paint_uniform_color(color)
-            cylinders.append(cylinder)
-        return cylinders
-
-    def visualize(self):
-        frames_axes = list()
-        connections_lines = o3d.geometry.LineSet()
-        corrections_lines = o3d.geometry.LineSet()
-        for node in self.pose_graph.nodes:
-            pose = node.pose
-            frame_axes = o3d.geometry.TriangleMesh.create_coordinate_frame(size=0.1)
-            frame_axes.transform(pose)
-            frames_axes.append(frame_axes)
-
-            position = pose[:3, 3]
-            connections_lines.points.append(position)
-            corrections_lines.points.append(position)
-
-        for edge in self.pose_graph.edges:
-            connections_lines.lines.append([edge.source_node_id, edge.target_node_id])
-            if edge.source_node_id + 1 == edge.target_node_id:
-                # odometry
-                connections_lines.colors.append([1.0, 0.0, 0.0])
+        # x is orthogonal to z, y completes right-handed frame
+        min_indices = np.argmin(np.abs(z), axis=1)
+        other_indices = np.array([[1, 2], [0, 2], [0, 1]])[min_indices]
+        z_other = np.take_along_axis(z, other_indices, axis=1)
+        z_other_norms = np.linalg.norm(z_other, axis=1)
+        x = np.zeros_like(z)
+        np.put_along_axis(x, other_indices[:, :1], -z_other[:, 1:] / z_other_norms[:, np.newaxis], axis=1)
+        np.put_along_axis(x, other_indices[:, 1:], z_other[:, :1] / z_other_norms[:, np.newaxis], axis=1)
+
+        y = np.cross(z, x)
+
+        transforms = np.tile(np.eye(4), (len(z), 1, 1))
+        transforms[:, :3, :3] = np.stack((x * radius, y * radius, z * lengths[:, np.newaxis]), axis=2)
+        transforms[:, :3, 3] = (starts + ends) / 2
+
+        cylinder = o3d.geometry.TriangleMesh.create_cylinder(radius=1, height=1)
+        return _instantiate_mesh(cylinder, transforms, colors=colors)
+
+    @staticmethod
+    def _lines_to_lineset(starts, ends, colors):
+        lineset = o3d.geometry.LineSet()
+        lineset.points = o3d.utility.Vector3dVector(np.vstack((starts, ends)))
+        lineset.lines = o3d.utility.Vector2iVector(
+            np.stack((np.arange(len(starts)), np.arange(len(starts)) + len(starts)), axis=1)
+                .astype(np.int32))
+        lineset.colors = o3d.utility.Vector3dVector(colors)
+        return lineset
+
+    def visualize(self, max_frames_axes=1000, lines_radius=0.001, map_voxel_size=0.005):
+        # max_frames_axes: coordinate frames are drawn for every k-th node,
+        #     so that at most max_frames_axes frames are drawn
+        # lines_radius: radius of cylinders drawn for edges and corrections.
+        #     If None, lines are drawn with LineSets.
+        with self._mutex:
+            nodes_poses = np.array([node.pose for node in self.pose_graph.nodes]).reshape(-1, 4, 4)
+            edges = np.array([(edge.source_node_id, edge.target_node_id)
+                for edge in self.pose_graph.edges], dtype=np.int64).reshape(-1, 2)
+        reference_poses = np.array(self.reference_poses).reshape(-1, 4, 4)
+
+        step = max(int(np.ceil(len(nodes_poses) / max_frames_axes)), 1)
+        frame_axes = o3d.geometry.TriangleMesh.create_coordinate_frame(size=0.1)
+        frames_axes = _instantiate_mesh(frame_axes, nodes_poses[::step])
+
+        positions = nodes_poses[:, :3, 3]
+        odometry = edges[:, 0] + 1 == edges[:, 1]
+        connections_colors = np.where(odometry[:, np.newaxis],
+            [[1.0, 0.0, 0.0]], [[1.0, 1.0, 0.0]])
+        corrections_colors = np.tile([0.0, 0.0, 1.0], (len(positions), 1))
+        lines = list()
+        for starts, ends, colors in (
+                (positions[edges[:, 0]], positions[edges[:, 1]], connections_colors),
+                (positions, reference_poses[:, :3, 3], corrections_colors)):
+            if lines_radius is None:
+                lines.append(self._lines_to_lineset(starts, ends, colors))
             else:
-                # loop
-                connections_lines.colors.append([1.0, 1.0, 0.0])
-        
-        for i, pose in enumerate(self.reference_poses):
-            position = pose[:3, 3]
-            corrections_lines.points.append(position)
-            corrections_lines.lines.append([i, i + len(self.reference_poses)])
-            corrections_lines.colors.append([0.0, 0.0, 1.0])
-
-        cylinders = list()
-        cylinders.extend(self._lineset_to_cylinders(connections_lines))
-        cylinders.extend(self._lineset_to_cylinders(corrections_lines))
-
-        merged_pc = o3d.geometry.PointCloud()
-        for node, frame in zip(self.pose_graph.nodes, self.reference_frames):
-            pc = o3d.geometry.PointCloud(frame)
-            pc.transform(node.pose)
-            merged_pc += pc
-        merged_pc = merged_pc.voxel_down_sample(0.005)
-
-        o3d.visualization.draw_geometries(frames_axes + cylinders + [merged_pc])
+                lines.append(self._lines_to_cylinders(starts, ends, colors, lines_radius))
+
+        map_builder = MapBuilder(map_voxel_size)
+        self.update_map(map_builder)
+        merged_pc = map_builder.to_point_cloud()
+
+        o3d.visualization.draw_geometries([frames_axes] + lines + [merged_pc])
+
+
+def _instantiate_mesh(mesh: o3d.geometry.TriangleMesh, transforms, colors=None):
+    # Merges copies of mesh transformed by transforms (shape - (k, 4, 4)) into one mesh.
+    # colors: shape - (k, 3), paints every copy with uniform color
+    vertices = np.asarray(mesh.vertices)
+    triangles = np.asarray(mesh.triangles)
+    k = len(transforms)
+
+    merged = o3d.geometry.TriangleMesh()
+    merged.vertices = o3d.utility.Vector3dVector(
+        (np.matmul(vertices, transforms[:, :3, :3].transpose(0, 2, 1)) +
+            transforms[:, np.newaxis, :3, 3]).reshape(-1, 3))
+    merged.triangles = o3d.utility.Vector3iVector(
+        (triangles[np.newaxis] + (np.arange(k) * len(vertices))[:, np.newaxis, np.newaxis])
+            .reshape(-1, 3).astype(np.int32))
+    if colors is not None:
+        merged.vertex_colors = o3d.utility.Vector3dVector(
+            np.repeat(colors, len(vertices), axis=0))
+    elif mesh.has_vertex_colors():
+        merged.vertex_colors = o3d.utility.Vector3dVector(
+            np.tile(np.asarray(mesh.vertex_colors), (k, 1)))
+    if mesh.has_vertex_normals() and k > 0:
+        # normals are transformed with inverse transpose to support scaling
+        normals_transforms = np.linalg.inv(transforms[:, :3, :3])
+        normals = np.matmul(np.asarray(mesh.vertex_normals), normals_transforms)
+        normals /= np.maximum(np.linalg.norm(normals, axis=2, keepdims=True), 1e-12)
+        merged.vertex_normals = o3d.utility.Vector3dVector(normals.reshape(-1, 3))
+    return merged
@@ -1,6 +1,10 @@
 import numpy as np
 import cv2
 import colorsys
+import threading
+import queue
+import weakref
+from functools import lru_cache
 
 
 # scores: shape - (n,), dtype - float
@@ -14,22 +18,22 @@ def draw_objects(image,
         format=None,
         palette=((0, 0, 255),), color_by_object_id=False):
 
-    def _check_label_fitness(image_size, text_size, text_pos):
+    def _check_labels_fitness(image_size, texts_sizes, texts_pos):
         image_width, image_height = image_size
-        text_width, text_height = text_size
-        text_x, text_y = text_pos
-
-        dx = 0
-        if text_x < 0:
-            dx = -text_x
-        elif text_x + text_width > image_width:
-            dx = image_width - text_x - text_width
-
-        dy = 0
-        if text_y < 0:
-            dy = -text_y
-        elif text_y + text_height > image_height:
-            dy = image_height - text_y - text_height
+        texts_width, texts_height = texts_sizes[:, 0], texts_sizes[:, 1]
+        texts_x, texts_y = texts_pos[:, 0], texts_pos[:, 1]
+
+        dx = np.zeros_like(texts_x)
+        left = texts_x < 0
+        dx[left] = -texts_x[left]
+        right = ~left & (texts_x + texts_width > image_width)
+        dx[right] = image_width - texts_x[right] - texts_width[right]
+
+        dy = np.zeros_like(texts_y)
+        top = texts_y < 0
+        dy[top] = -texts_y[top]
+        bottom = ~top & (texts_y + texts_height > image_height)
+        dy[bottom] = image_height - texts_y[bottom] - texts_height[bottom]
         return dx, dy
 
     if boxes is None and masks is None:
@@ -66,6 +70,7 @@ def draw_objects(image,
         objects_ids = [None] * num
     if boxes is None:
         boxes = [None] * num
+    has_masks = masks is not None
     if masks is None:
         masks = [None] * num
     if customs is None:
@@ -82,61 +87,362 @@ def draw_objects(image,
     width = image.shape[1]
     height = image.shape[0]
     overlay = image.copy()
-    for i, (score, object_id, box, mask, custom) in enumerate(zip(scores, objects_ids, boxes, masks, customs)):
-        if score is not None and score < min_score:
-            continue
 
+    # indices of objects that pass min_score
+    kept = [i for i, score in enumerate(scores)
+        if score is None or score >= min_score]
+
+    colors = np.empty((len(kept) + 1, 3), dtype=np.uint8)
+    for k, i in enumerate(kept, start=1):
         if color_by_object_id:
-            color = palette[object_id % len(palette)]
+            colors[k] = palette[objects_ids[i] % len(palette)]
         else:
-            color = palette[i % len(palette)]
+            colors[k] = palette[i % len(palette)]
 
-        if format:
-            text = format.format(s=score, i=object_id, c=custom)
+    # masks bounding rois are needed for labels anchors, masks and contours
+    if has_masks and (draw_masks or any(boxes[i] is None for i in kept)):
+        rois = _get_masks_rois([masks[i] for i in kept])
+    else:
+        rois = [None] * len(kept)
+
+    if draw_masks:
+        # compose all masks into a single label image, later masks overwrite earlier ones
+        labels = np.zeros((height, width), dtype=np.int32)
+        for k, (i, roi) in enumerate(zip(kept, rois), start=1):
+            if roi is None:
+                continue
+            labels[roi][masks[i][roi] != 0] = k
+
+    if format:
+        # place all labels at once
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        font_scale = 1
+        thickness = 2
+        texts = list()
+        texts_sizes = np.empty((len(kept), 2), dtype=int)
+        texts_pos = np.empty((len(kept), 2), dtype=int)
+        y_bottoms = np.empty((len(kept),), dtype=int)
+        for k, (i, roi) in enumerate(zip(kept, rois)):
+            text = format.format(s=scores[i], i=objects_ids[i], c=customs[i])
+            box = boxes[i]
             if box is not None:
                 x, y_top, y_bottom = box[0], box[1], box[3]
             else:
-                nonzero_y, nonzero_x = np.nonzero(mask)
-                x, y_top, y_bottom = nonzero_x.min(), nonzero_y.min(), nonzero_y.max()
-            y = y_top - 5
-            font = cv2.FONT_HERSHEY_SIMPLEX
-            font_scale = 1
-            thickness = 2
-            text_size, _ = cv2.getTextSize(text, font, font_scale, thickness)
-            dx, dy = _check_label_fitness((width, height), text_size, (x, y))
-            x += dx
-            if dy > 0:
-                y = y_bottom + text_size[1] + 5
-            cv2.putText(image, text, (x, y), font, font_scale, color, thickness=thickness)
+                if roi is None:
+                    raise RuntimeError(f"Mask {i} is empty")
+                y_range, x_range = roi
+                x, y_top, y_bottom = x_range.start, y_range.start, y_range.stop - 1
+            texts.append(text)
+            texts_sizes[k] = _render_label(text, font, font_scale, thickness)[0]
+            texts_pos[k] = (x, y_top - 5)
+            y_bottoms[k] = y_bottom
+        dx, dy = _check_labels_fitness((width, height), texts_sizes, texts_pos)
+        texts_pos[:, 0] += dx
+        below = dy > 0
+        texts_pos[below, 1] = y_bottoms[below] + texts_sizes[below, 1] + 5
+
+    for k, (i, roi) in enumerate(zip(kept, rois), start=1):
+        box, mask = boxes[i], masks[i]
+        color = tuple(int(c) for c in colors[k])
+
+        if format:
+            _draw_label(image, texts[k - 1], texts_pos[k - 1],
+                font, font_scale, color, thickness)
 
         if draw_boxes:
             x1, y1, x2, y2 = box
             cv2.rectangle(image, (x1, y1), (x2, y2), color, thickness=2)
 
-        if draw_masks:
-            overlay[mask != 0] = np.array(color, dtype=np.uint8)
-            if not draw_boxes:
-                polygons, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-                cv2.polylines(image, polygons, True, color, thickness=2)
+        if draw_masks and not draw_boxes and roi is not None:
+            # pad roi by 1 pixel so that contours are not affected by crop borders
+            y_range, x_range = roi
+            from_y, to_y = max(y_range.start - 1, 0), min(y_range.stop + 1, height)
+            from_x, to_x = max(x_range.start - 1, 0), min(x_range.stop + 1, width)
+            mask_in_roi = np.ascontiguousarray(mask[from_y:to_y, from_x:to_x])
+            polygons, _ = cv2.findContours(mask_in_roi,
+                cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=(from_x, from_y))
+            cv2.polylines(image, polygons, True, color, thickness=2)
 
+    if draw_masks:
+        selected = labels != 0
+        overlay[selected] = colors[labels[selected]]
     cv2.addWeighted(image, 0.7, overlay, 0.3, 0, dst=image)
 
 
-def draw_points(image, K, D, points, min_distance=0.2, max_distance=4.0, radius=2):
-    points_2d, _ = cv2.projectPoints(points, np.zeros((3,)), np.zeros((3,)), K, D)
-    points_2d = points_2d.squeeze()
+@lru_cache(maxsize=1024)
+def _render_label(text, font, font_scale, thickness):
+    # returns text size, alpha bitmap of the rendered text and
+    # position of the bitmap relative to the text origin
+    text_size, baseline = cv2.getTextSize(text, font, font_scale, thickness)
+    text_width, text_height = text_size
+    pad = thickness + 2
+    canvas = np.zeros((text_height + baseline + 2 * pad, text_width + 2 * pad), dtype=np.uint8)
+    cv2.putText(canvas, text, (pad, pad + text_height), font, font_scale, 1, thickness=thickness)
+    rows = np.flatnonzero(canvas.any(axis=1))
+    cols = np.flatnonzero(canvas.any(axis=0))
+    if len(rows) == 0:
+        return text_size, np.zeros((0, 0), dtype=bool), (0, 0)
+    alpha = canvas[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1] != 0
+    alpha.flags.writeable = False
+    return text_size, alpha, (cols[0] - pad, rows[0] - pad - text_height)
+
+
+def _draw_label(image, text, text_pos, font, font_scale, color, thickness):
+    # same as cv2.putText(), but blits a cached rendered label
+    _, alpha, (offset_x, offset_y) = _render_label(text, font, font_scale, thickness)
     h, w = image.shape[:2]
-    for point, point_2d in zip(points, points_2d):
-        if point[2] <= 0:
-            continue
-        x, y = map(int, point_2d)
-        if x < 0 or y < 0 or x >= w or y >= h:
+    from_x = text_pos[0] + offset_x
+    from_y = text_pos[1] + offset_y
+    to_x = from_x + alpha.shape[1]
+    to_y = from_y + alpha.shape[0]
+    if from_x < 0 or from_y < 0 or to_x > w or to_y > h:
+        # putText() rasterizes strokes clipped by the image border differently
+        # from a cropped bitmap, so draw labels crossing the border directly
+        cv2.putText(image, text, tuple(int(v) for v in text_pos), font, font_scale,
+            color, thickness=thickness)
+        return
+    image[from_y:to_y, from_x:to_x][alpha] = color
+
+
+def _get_masks_rois(masks):
+    # bounding rois of masks, None for empty masks
+    rois = list()
+    for mask in masks:
+        rows = np.flatnonzero(mask.any(axis=1))
+        if len(rows) == 0:
+            rois.append(None)
             continue
+        y_min, y_max = rows[0], rows[-1]
+        cols = np.flatnonzero(mask[y_min:y_max + 1].any(axis=0))
+        x_min, x_max = cols[0], cols[-1]
+        rois.append((slice(y_min, y_max + 1), slice(x_min, x_max + 1)))
+    return rois
+
+
+def draw_points(image, K, D, points, min_distance=0.2, max_distance=4.0, radius=2,
+        z_buffer=False):
+    # z_buffer: if True, nearer points are drawn over farther ones,
+    #     otherwise points are drawn in the given order
+    points = np.asarray(points).reshape(-1, 3)
+    points_indices = np.flatnonzero(points[:, 2] > 0)
+    points = points[points_indices]
+    if len(points) == 0:
+        return
+
+    points_2d = _project_points(points, K, D).astype(int)
+    h, w = image.shape[:2]
+    x, y = points_2d[:, 0], points_2d[:, 1]
+    in_image = (x >= 0) & (y >= 0) & (x < w) & (y < h)
+    x, y = x[in_image], y[in_image]
+    points = points[in_image]
+    points_indices = points_indices[in_image]
+    if len(points) == 0:
+        return
+
+    dist = np.linalg.norm(points, axis=1)
+    dist = np.clip(dist, min_distance, max_distance)
+    k = (dist - min_distance) / (max_distance - min_distance)
+    hue = (240 * (1 - k)).astype(int)
+    colors = _DISTANCE_COLORMAP[hue]
+
+    # the point with the smallest priority wins when points overlap
+    if z_buffer:
+        priority = dist
+    else:
+        priority = -points_indices
+
+    # points with lower rank are drawn over points with higher rank
+    n = len(priority)
+    rank = np.empty(n, dtype=np.int32)
+    rank[np.argsort(priority, kind='stable')] = np.arange(n, dtype=np.int32)
+    colors_by_rank = np.empty_like(colors)
+    colors_by_rank[rank] = colors
+
+    # keep a single point per pixel
+    pixels = y * w + x
+    order = np.argsort(pixels.astype(np.int64) * n + rank)
+    pixels = pixels[order]
+    first = np.ones(len(pixels), dtype=bool)
+    first[1:] = pixels[1:] != pixels[:-1]
+    centers_rank = np.full((h, w), n, dtype=np.int32)
+    centers_rank.flat[pixels[first]] = rank[order[first]]
+
+    # splat disks by shifting the centers image
+    rank_buffer = np.full((h, w), n, dtype=np.int32)
+    for dx, dy in _get_disk_offsets(radius):
+        dst = (slice(max(dy, 0), h + min(dy, 0)), slice(max(dx, 0), w + min(dx, 0)))
+        src = (slice(max(-dy, 0), h + min(-dy, 0)), slice(max(-dx, 0), w + min(-dx, 0)))
+        np.minimum(rank_buffer[dst], centers_rank[src], out=rank_buffer[dst])
+
+    drawn = rank_buffer != n
+    image[drawn] = colors_by_rank[rank_buffer[drawn]]
+
+
+def _project_points(points, K, D):
+    # same as cv2.projectPoints() with zero rvec and tvec for points with z > 0
+    D = np.zeros((0,)) if D is None else np.asarray(D).ravel()
+    if len(D) > 8:
+        points_2d, _ = cv2.projectPoints(points, np.zeros((3,)), np.zeros((3,)), K, D)
+        return points_2d.reshape(-1, 2)
+
+    x = points[:, 0] / points[:, 2]
+    y = points[:, 1] / points[:, 2]
+    if np.any(D != 0):
+        k1, k2, p1, p2, k3, k4, k5, k6 = np.pad(D, (0, 8 - len(D)))
+        r2 = x * x + y * y
+        r4 = r2 * r2
+        r6 = r4 * r2
+        radial = (1 + k1 * r2 + k2 * r4 + k3 * r6) / (1 + k4 * r2 + k5 * r4 + k6 * r6)
+        x, y = \
+            x * radial + 2 * p1 * x * y + p2 * (r2 + 2 * x * x), \
+            y * radial + p1 * (r2 + 2 * y * y) + 2 * p2 * x * y
+
+    points_2d = np.empty((len(points), 2))
+    points_2d[:, 0] = K[0, 0] * x + K[0, 2]
+    points_2d[:, 1] = K[1, 1] * y + K[1, 2]
+    return points_2d
 
-        dist = np.linalg.norm(point)
-        dist = np.clip(dist, min_distance, max_distance)
-        k = (dist - min_distance) / (max_distance - min_distance)
-        hue = int(240 * (1 - k))
+
+def _get_distance_colormap():
+    # hue in degrees -> (b, g, r)
+    colormap = np.empty((241, 3), dtype=np.uint8)
+    for hue in range(241):
         r, g, b = colorsys.hsv_to_rgb(hue / 360, 1.0, 1.0)
-        r, g, b = [int(item * 255) for item in (r, g, b)]
-        cv2.circle(image, (x, y), radius, (b, g, r), -1)
+        colormap[hue] = [int(item * 255) for item in (b, g, r)]
+    return colormap
+
+
+_DISTANCE_COLORMAP = _get_distance_colormap()
+
+
+@lru_cache(maxsize=16)
+def _get_disk_offsets(radius):
+    # pixels covered by cv2.circle() relative to its center
+    disk = np.zeros((2 * radius + 1, 2 * radius + 1), dtype=np.uint8)
+    cv2.circle(disk, (radius, radius), radius, 1, -1)
+    dy, dx = np.nonzero(disk)
+    return tuple(zip(dx - radius, dy - radius))
+
+
+class _VideoSinkState:
+    # state shared by VideoSink and its encoding thread,
+    # the thread must not reference VideoSink so that it can be garbage collected
+    def __init__(self, out_file, fps, fourcc):
+        self.out_file = out_file
+        self.fps = fps
+        self.fourcc = fourcc
+        self.writer = None
+        self.frame_size = None
+        self.error = None
+        self.frames_written = 0
+
+
+def _run_video_sink(frames_queue, state: _VideoSinkState):
+    # frames are taken from the queue until None even after an error,
+    # so write() and close() never block on a full queue
+    while True:
+        frame = frames_queue.get()
+        if frame is None:
+            break
+        if state.error is not None:
+            continue
+        try:
+            _write_video_frame(frame, state)
+        except Exception as e:
+            state.error = f"{type(e).__name__}: {e}"
+
+
+def _write_video_frame(frame, state: _VideoSinkState):
+    if state.writer is None:
+        state.frame_size = (frame.shape[1], frame.shape[0])
+        state.writer = cv2.VideoWriter(state.out_file,
+            cv2.VideoWriter_fourcc(*state.fourcc), state.fps, state.frame_size,
+            isColor=(frame.ndim == 3))
+        if not state.writer.isOpened():
+            state.error = f"Could not open video file {state.out_file}"
+            return
+    if (frame.shape[1], frame.shape[0]) != state.frame_size:
+        frame = cv2.resize(frame, state.frame_size)
+    state.writer.write(frame)
+    state.frames_written += 1
+
+
+def _close_video_sink(frames_queue, thread, state: _VideoSinkState):
+    frames_queue.put(None)
+    thread.join()
+    if state.writer is not None:
+        state.writer.release()
+
+
+class VideoSink:
+    # Encodes frames to a video file in a background thread.
+    # Frames passed to write() must not be modified afterwards.
+    # The video is finalized by close(), on exit from with block,
+    # when the sink is garbage collected or at interpreter exit.
+
+    DROP_OLDEST = 0
+    DROP_NEWEST = 1
+    BLOCK = 2
+
+    def __init__(self, out_file, fps=30, fourcc="mp4v", queue_size=64,
+            drop_policy=DROP_OLDEST):
+        assert drop_policy in (
+            VideoSink.DROP_OLDEST,
+            VideoSink.DROP_NEWEST,
+            VideoSink.BLOCK)
+
+        self.out_file = out_file
+        self.fps = fps
+        self.fourcc = fourcc
+        self.drop_policy = drop_policy
+
+        self.frames_dropped = 0
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._state = _VideoSinkState(out_file, fps, fourcc)
+        self._thread = threading.Thread(target=_run_video_sink,
+            args=(self._queue, self._state), daemon=True)
+        self._thread.start()
+        self._finalizer = weakref.finalize(self, _close_video_sink,
+            self._queue, self._thread, self._state)
+
+    @property
+    def frames_written(self):
+        return self._state.frames_written
+
+    def write(self, frame):
+        if not self._finalizer.alive:
+            raise RuntimeError("Video sink is closed")
+        if self._state.error is not None:
+            raise RuntimeError(self._state.error)
+
+        if self.drop_policy == VideoSink.BLOCK:
+            self._queue.put(frame)
+            return
+
+        while True:
+            try:
+                self._queue.put_nowait(frame)
+                return
+            except queue.Full:
+                if self.drop_policy == VideoSink.DROP_NEWEST:
+                    self.frames_dropped += 1
+                    return
+            try:
+                self._queue.get_nowait()
+                self.frames_dropped += 1
+            except queue.Empty:
+                pass
+
+    def close(self):
+        if not self._finalizer.alive:
+            return
+        self._finalizer()
+        if self._state.error is not None:
+            raise RuntimeError(self._state.error)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()